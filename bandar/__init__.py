@@ -22,21 +22,37 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-import atexit
+import asyncio
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 import logging
 import os
 import os.path
+import queue
 import subprocess
 import sys
-from tempfile import TemporaryDirectory
-
-from .poudriere import Poudriere
+import threading
+import time
+
+from . import runner
+from .engine import run_sync
+from .archivers import git_changed_ports, git_list_ports
+from .cache import DependencyCache, LintCache
+from .graph import DependencyGraph, dependents
+from .makefile import MakefileEvaluator, UsesTable
+from .overlay import Overlay, OverlaySession, check_path
+from .plan import BuildPlan, DurationHistory, Schedule
+from .poudriere import PersistentTrees, Poudriere, distfiles_dir
+from .rdeps import ReverseIndex
+from .query import PortQuery, port_info_dict, port_info_from_dict
 
 logger = logging.getLogger(os.path.basename('bandar'))
 
 
 LintResult = namedtuple('LintResult', ['warnings', 'errors'])
+TestResult = namedtuple('TestResult', ['port', 'passed', 'elapsed',
+                                       'skipped'])
 
 
 def extend_env(**kwargs):
@@ -45,141 +61,456 @@ def extend_env(**kwargs):
     return env
 
 
-def check_path(path, rel=None):
-    if rel is not None:
-        path = os.path.join(rel, path)
-    abspath = os.path.abspath(path)
-    if os.path.isdir(abspath):
-        return abspath
-    raise ValueError("The path '%s' does not exist!" % abspath)
+RUN_DEPENDS = ('lib_depends', 'run_depends')
+ALL_DEPENDS = ('build_depends', 'lib_depends', 'run_depends', 'test_depends')
 
 
 class TreeGenerator:
-    def __init__(self, bandar, excludes=None):
+    def __init__(self, bandar, excludes=None, jobs=1, dep_cache=None,
+                 depends=RUN_DEPENDS, evaluator=None, verify=False):
         self.excludes = excludes or []
+        self.jobs = max(1, jobs)
+        self.dep_cache = dep_cache
+        self.depends = depends
         self.cache = {}
-        self.mnt = bandar.overlay.mountpoint
-        self.mnt_len = len(self.mnt) + 1
-        self.cmd = ['make', 'run-depends-list']
-        self.env = extend_env(PORTSDIR=self.mnt)
-
-    def strip_mount(self, path):
-        if path.startswith(self.mnt):
-            return path[self.mnt_len:]
-        return path
-
-    def run(self, port_path):
-        if port_path in self.cache:
-            return self.cache[port_path]
-        root = []
-
-        path = os.path.join(self.mnt, port_path)
-        data = subprocess.check_output(self.cmd, cwd=path, env=self.env)
-        ports = data.decode().strip()
-
-        if ports == '':
-            logger.debug('%s: <end>' % port_path)
-            return root
-
-        ports = ports.split('\n')
-        logger.debug("%s: %r" % (port_path, ports))
-
-        for port in ports:
-            # Strip mnt prefix
-            port = self.strip_mount(port)
-            if port in self.excludes:
+        self.deps = {}
+        self.timings = {}
+        self.evaluator = evaluator
+        self.port_query = PortQuery(bandar.overlay.mountpoint, evaluator,
+                                    verify)
+        self.__tasks = {}
+
+    async def port_info_async(self, engine, port_path):
+        if self.dep_cache is not None:
+            info = self.dep_cache.get(port_path)
+            if info is not None:
+                return port_info_from_dict(info)
+
+        start = time.monotonic()
+        info = await self.port_query.query_async(engine, port_path)
+        self.timings[port_path] = time.monotonic() - start
+        logger.debug("%s: %r" % (port_path, info))
+
+        # The Makefile reader's answers are only good for --fast runs, so
+        # they're never cached for later ones.
+        if self.dep_cache is not None and \
+                port_path not in self.port_query.unverified:
+            self.dep_cache.put(port_path, port_info_dict(info))
+        return info
+
+    async def query_async(self, engine, port_path):
+        return self.children(await self.port_info_async(engine, port_path))
+
+    def children(self, info):
+        # By default this matches `make run-depends-list`, which covers
+        # LIB_ and RUN_DEPENDS
+        ports = []
+        for kind in self.depends:
+            for port in getattr(info, kind):
+                if port not in ports and port not in self.excludes:
+                    ports.append(port)
+        return ports
+
+    @contextmanager
+    def saving(self):
+        # Saves whatever the walks inside learnt, however they end.
+        try:
+            yield self
+        finally:
+            if self.dep_cache is not None:
+                self.dep_cache.save()
+            if self.evaluator is not None:
+                self.evaluator.save()
+
+    def walk(self, *port_paths):
+        # At most `jobs` make processes are busy on the frontier at once.
+        run_sync(self.walk_async, *port_paths, jobs=self.jobs)
+
+    async def __visit(self, engine, port_path):
+        self.deps[port_path] = await self.query_async(engine, port_path)
+        return port_path
+
+    async def walk_async(self, engine, *port_paths):
+        # Concurrent walks on one generator share each other's queries, so
+        # no port is ever queried twice.
+        loop = asyncio.get_running_loop()
+
+        def visit(port):
+            task = self.__tasks.get(port)
+            if task is None or task.get_loop() is not loop:
+                # Ports walked on an earlier loop are already done.
+                if port in self.deps:
+                    task = loop.create_future()
+                    task.set_result(port)
+                else:
+                    task = asyncio.ensure_future(self.__visit(engine, port))
+                self.__tasks[port] = task
+            return task
+
+        seen = set(port_paths)
+        pending = set(visit(p) for p in port_paths)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for child in self.deps[task.result()]:
+                        if child not in seen:
+                            seen.add(child)
+                            pending.add(visit(child))
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+
+    def graph(self, port_path):
+        with self.saving():
+            self.walk(port_path)
+        return self.make_graph(port_path)
+
+    def make_graph(self, *port_paths):
+        graph = DependencyGraph()
+        order = [graph.intern(p) for p in port_paths]
+        for node in order:
+            # Newly interned ports get the next ids; queue them up.
+            count = len(graph)
+            graph.add(graph.names[node], self.deps[graph.names[node]])
+            order.extend(range(count, len(graph)))
+        return graph
+
+    def build(self, port_path):
+        stack = [(port_path, False)]
+        while stack:
+            port, expanded = stack.pop()
+            if port in self.cache:
                 continue
-            root.append((port, self.run(port)))
-
-        self.cache[port_path] = root
-        return root
-
-class Overlay:
-    @property
-    def workspace(self):
-        return self._workspace.name
-
-    @property
-    def mountpoint(self):
-        return self._mountpoint.name
-
-    def __init__(self, layers, workspace=None, mountpoint=None, max_files=65536):
-        ufs_layers = self.__gen_layers(layers)
-
-        self._workspace = workspace or TemporaryDirectory(prefix="bandar-work-")
-        self._mountpoint = mountpoint or TemporaryDirectory(prefix="bandar-mnt-")
-
-        cmd = ['unionfs', '-o', 'cow,max_files=%s' % max_files,
-                "%s=RW:%s" % (self.workspace, ufs_layers),
-                self.mountpoint]
-        logger.debug(cmd)
-
-        subprocess.check_output(cmd)
-
-        self.__unmounted = False
-        atexit.register(self.__unmount)
-
-    def __del__(self):
-        if self.__unmounted is False:
-            self.__unmount()
-
-    def __unmount(self):
-        atexit.unregister(self.__unmount)
-        subprocess.call(['umount', '-f', self.mountpoint])
-        self.__unmounted = True
-
-    def __gen_layers(self, layers):
-        abslayers = ["%s=RO" % check_path(layer) for layer in layers]
-        return ":".join(abslayers)
+            if expanded:
+                self.cache[port] = [(c, self.cache[c]) for c in self.deps[port]]
+            else:
+                stack.append((port, True))
+                stack.extend((c, False) for c in self.deps[port]
+                             if c not in self.cache)
+        return self.cache[port_path]
 
+    def run(self, port_path):
+        graph = self.graph(port_path)
+        cycles = graph.find_cycles(port_path)
+        if len(cycles) > 0:
+            raise ValueError("Dependency cycle: %s" % " -> ".join(cycles[0]))
+        return self.build(port_path)
 
 class Bandar:
-    def __init__(self, proj_dir, ports_dir):
+    def __init__(self, proj_dir, ports_dir, use_session=True,
+                 backend=None, distfiles=None):
         self.proj_dir = check_path(proj_dir)
         self.ports_dir = check_path(ports_dir)
-        self.overlay = Overlay([self.proj_dir, self.ports_dir])
-
-    def __test_port(self, port_path):
-        cmd = ['port', 'test']
-        env = extend_env(PORTSDIR=self.overlay.mountpoint)
-        ret = subprocess.call(cmd, cwd=port_path, env=env)
-        return ret == 0
+        self.backend = backend
+        self.distfiles = distfiles
+
+        # Reuse a running `bandar overlay up` session where there is one,
+        # as long as it uses the backend asked for (any, if none was).
+        self.overlay = None
+        if use_session:
+            self.overlay = self.session().attach(backend)
+        if self.overlay is None:
+            self.overlay = self.new_overlay()
+
+    def new_overlay(self):
+        return Overlay([self.proj_dir, self.ports_dir],
+            backend=self.backend or 'unionfs')
+
+    def session(self):
+        return OverlaySession([self.proj_dir, self.ports_dir])
+
+    @contextmanager
+    def distdir(self, path):
+        # The DISTDIR for a run in the port directory `path`, from the
+        # shared distfile cache if there is one.
+        if self.distfiles is None:
+            yield {}
+            return
+        with self.distfiles.checkout(path) as env:
+            yield env
+
+    @asynccontextmanager
+    async def distdir_async(self, engine, path):
+        # distdir(), with the seeding, locking and checksums done off the
+        # event loop.
+        cm = self.distdir(path)
+        env = await engine.run_blocking(cm.__enter__)
+        try:
+            yield env
+        except BaseException:
+            if not await engine.run_blocking(cm.__exit__, *sys.exc_info()):
+                raise
+        else:
+            await engine.run_blocking(cm.__exit__, None, None, None)
+
+    @contextmanager
+    def __poudriere_distfiles(self, ports):
+        distdir = distfiles_dir()
+        if self.distfiles is None or distdir is None:
+            yield
+            return
+        paths = [check_path(p.split('@', 1)[0], self.overlay.mountpoint)
+                 for p in ports]
+        with self.distfiles.shared(distdir, paths):
+            yield
+
+    def __test_port(self, port_path, overlay=None, log_dir=None):
+        return run_sync(self.test_port_async, port_path, log_dir, None,
+            overlay)
+
+    def __test_worker(self, overlay, take, results, log_dir):
+        try:
+            if overlay is None:
+                overlay = self.new_overlay()
+        except Exception as e:
+            results.put(e)
+            return
 
-    def test_ports(self, port_paths):
-        paths = [check_path(p, self.overlay.mountpoint) for p in port_paths]
-        for p in paths:
-            self.__test_port(p)
+        try:
+            while True:
+                port_path = take()
+                if port_path is None:
+                    break
+                try:
+                    results.put(self.__test_port(port_path, overlay, log_dir))
+                except Exception as e:
+                    results.put(e)
+        finally:
+            if overlay is not self.overlay:
+                overlay.close()
+
+    def iter_test_ports(self, port_paths, jobs=1, log_dir=None, plan=None):
+        # With a plan, ports only start once their dependencies have
+        # passed, and the dependents of a failure are skipped.
+        if plan is not None:
+            port_paths = plan.ports
+        for p in port_paths:
+            check_path(p, self.overlay.mountpoint)
+
+        if plan is not None:
+            schedule = Schedule(plan)
+            take = schedule.take
+        else:
+            schedule = None
+            ports = queue.Queue()
+            for p in port_paths:
+                ports.put(p)
+
+            def take():
+                try:
+                    return ports.get_nowait()
+                except queue.Empty:
+                    return None
+
+        def finish(res):
+            yield res
+            if schedule is not None:
+                for p in schedule.done(res.port, res.passed):
+                    yield TestResult(p, False, 0.0, True)
+
+        if jobs <= 1:
+            while True:
+                p = take()
+                if p is None:
+                    return
+                yield from finish(self.__test_port(p, log_dir=log_dir))
+
+        # Every worker gets its own copy-on-write overlay over the same
+        # read-only layers, so concurrent `work/` directories never meet.
+        results = queue.Queue()
+        workers = []
+        for i in range(min(jobs, len(port_paths))):
+            overlay = self.overlay if i == 0 else None
+            t = threading.Thread(target=self.__test_worker,
+                args=(overlay, take, results, log_dir), daemon=True)
+            t.start()
+            workers.append(t)
+
+        left = len(port_paths)
+        try:
+            while left > 0:
+                res = results.get()
+                if isinstance(res, Exception):
+                    raise res
+                for r in finish(res):
+                    left -= 1
+                    yield r
+        finally:
+            if schedule is not None:
+                schedule.cancel()
+
+        for t in workers:
+            t.join()
+
+    def test_ports(self, port_paths, jobs=1, log_dir=None, plan=None):
+        return list(self.iter_test_ports(port_paths, jobs, log_dir, plan))
 
     def test_port(self, port_path):
-        p = check_path(port_path, self.overlay.mountpoint)
-        self.__test_port(p)
-
-    def bulk_build(self, jail_name, ports):
-        p = Poudriere(self.overlay.mountpoint)
-        return p.bulk(jail_name, *ports)
+        return self.__test_port(port_path)
+
+    def ports_tree(self, persistent=False, tree_name=None):
+        # A persistent tree is a named one on the session overlay, which is
+        # brought up if it isn't already.
+        overlay = self.overlay
+        if persistent and not overlay.persistent:
+            overlay = self.session().up(backend=self.backend or 'unionfs')
+
+        if not overlay.backend.jail_safe:
+            raise ValueError("The '%s' overlay backend can't be used inside "
+                "a poudriere jail!" % overlay.backend.name)
+
+        if persistent:
+            return PersistentTrees().get(self.session(), overlay, tree_name)
+        return Poudriere(overlay.mountpoint)
+
+    def bulk_build(self, jail_name, ports, persistent=False, tree_name=None,
+                   watcher=None):
+        p = self.ports_tree(persistent, tree_name)
+        with self.__poudriere_distfiles(ports):
+            return p.bulk(jail_name, *ports, watcher=watcher)
+
+    def bulk_build_many(self, jail_names, ports, jobs=None, log_dir=None,
+                        on_update=None, persistent=False, tree_name=None,
+                        watch=False):
+        p = self.ports_tree(persistent, tree_name)
+        with self.__poudriere_distfiles(ports):
+            return p.bulk_many(jail_names, ports, jobs, log_dir, on_update,
+                watch)
+
+    def __lint_parser(self):
+        prefix = self.overlay.mountpoint + '/'
+        res = LintResult(warnings=[], errors=[])
+
+        def parse(line):
+            if line.startswith("WARN"):
+                res.warnings.append(line.replace(prefix, ''))
+            elif line.startswith("FATAL"):
+                res.errors.append(line.replace(prefix, ''))
+        return res, parse
 
     def lint_port(self, port_path, *args):
+        return run_sync(self.lint_port_async, port_path, *args)
+
+    async def lint_port_async(self, engine, port_path, *args):
         mnt = self.overlay.mountpoint
         cmd = ['portlint'] + list(args) + [port_path]
-        env = extend_env(PORTSDIR=mnt)
-
-        try:
-            data = subprocess.check_output(cmd, cwd=mnt, env=env)
-        except subprocess.CalledProcessError as e:
-            # if >= 0, just means linting found an error
-            if e.returncode >= 0:
-                data = e.output
+        res, parse = self.__lint_parser()
+
+        # portlint never fetches, so it gets no DISTDIR of its own.
+        ret = (await engine.run(cmd, cwd=mnt, env=extend_env(PORTSDIR=mnt),
+            on_line=parse)).returncode
+        # if >= 0, just means linting found an error; otherwise, propagate
+        if ret < 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+        return res
+
+    async def test_port_async(self, engine, port_path, log_dir=None,
+                              timeout=None, overlay=None):
+        overlay = overlay or self.overlay
+        path = check_path(port_path, overlay.mountpoint)
+
+        start = time.monotonic()
+        async with self.distdir_async(engine, path) as dist:
+            env = extend_env(PORTSDIR=overlay.mountpoint, **dist)
+            if log_dir is None:
+                ret = (await engine.run(['port', 'test'], cwd=path, env=env,
+                    timeout=timeout, stdout=None)).returncode
             else:
-                # Otherwise, propagate
-                raise e
-
-        results = data.decode().strip().split('\n')
-
-        out = LintResult(
-            warnings=[x.replace(mnt + '/', '') for x in results if x.startswith("WARN")],
-            errors=[x.replace(mnt + '/', '') for x in results if x.startswith("FATAL")])
-
-        return out
-
-    def generate_dependency_tree(self, port_path, excludes=None):
-        return TreeGenerator(self, excludes).run(port_path)
+                log_fn = os.path.join(log_dir, '%s.log' %
+                    port_path.replace('/', '_'))
+                with open(log_fn, 'wb') as f:
+                    ret = (await engine.run(['port', 'test'], cwd=path,
+                        env=env, timeout=timeout, stdout=f,
+                        stderr=subprocess.STDOUT)).returncode
+
+        return TestResult(port_path, ret == 0, time.monotonic() - start, False)
+
+    async def port_info_async(self, engine, port_path):
+        return await PortQuery(self.overlay.mountpoint).query_async(engine,
+            port_path)
+
+    def __lint_cached(self, port_path, args, lint_cache, key):
+        data = lint_cache.get(key)
+        if data is not None:
+            return LintResult(**data)
+        res = self.lint_port(port_path, *args)
+        lint_cache.put(key, dict(res._asdict()))
+        return res
+
+    def lint_ports(self, port_paths, *args, jobs=1, lint_cache=None):
+        if lint_cache is None:
+            lint = lambda p: self.lint_port(p, *args)
+        else:
+            keys = lint_cache.keys(port_paths, args)
+            lint = lambda p: self.__lint_cached(p, args, lint_cache, keys[p])
+
+        # Results are yielded in the order given, each as soon as it and
+        # every port before it has finished.
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = [pool.submit(lint, p) for p in port_paths]
+            for port_path, future in zip(port_paths, futures):
+                yield port_path, future.result()
+
+    def portlint_version(self):
+        data = runner.check_output(['portlint', '-v'])
+        return data.decode().strip()
+
+    def lint_cache(self):
+        return LintCache([self.proj_dir, self.ports_dir],
+            self.portlint_version())
+
+    def dependency_cache(self):
+        return DependencyCache([self.proj_dir, self.ports_dir])
+
+    def makefile_evaluator(self):
+        layers = [self.proj_dir, self.ports_dir]
+        return MakefileEvaluator(self.overlay.mountpoint,
+            UsesTable(self.overlay.mountpoint, layers))
+
+    def port_info(self, port_path):
+        return run_sync(self.port_info_async, port_path)
+
+    def ports_info(self, port_paths):
+        return PortQuery(self.overlay.mountpoint).query_many(port_paths)
+
+    def changed_ports(self, ref):
+        return git_changed_ports(self.proj_dir, ref)
+
+    def reverse_dependencies(self, port_paths, candidates=None, jobs=None):
+        # Which of `candidates` (by default every dev port) depend on any
+        # of `port_paths`, directly or transitively, by any dependency kind.
+        if candidates is None:
+            candidates = git_list_ports(self.proj_dir)
+
+        dep_cache = self.dependency_cache()
+        gen = TreeGenerator(self, jobs=jobs or os.cpu_count() or 1,
+            dep_cache=dep_cache, depends=ALL_DEPENDS)
+        with gen.saving():
+            gen.walk(*candidates)
+
+        found = dependents(gen.deps, port_paths)
+        return [p for p in candidates if p in found]
+
+    def build_plan(self, port_paths, kind='test', jobs=None, use_cache=True,
+                   evaluator=None):
+        dep_cache = self.dependency_cache() if use_cache else None
+        gen = TreeGenerator(self, jobs=jobs or os.cpu_count() or 1,
+            dep_cache=dep_cache, depends=ALL_DEPENDS, evaluator=evaluator)
+        with gen.saving():
+            gen.walk(*port_paths)
+        return BuildPlan(gen.make_graph(*port_paths), port_paths,
+            DurationHistory().durations(kind))
+
+    def reverse_index(self, generate=False):
+        return ReverseIndex.for_ports(self.ports_dir, generate)
+
+    def upstream_rdeps(self, port_path, kinds=None, transitive=True):
+        return self.reverse_index().rdeps(port_path, kinds, transitive)
+
+    def generate_dependency_tree(self, port_path, excludes=None, jobs=1,
+                                 use_cache=True):
+        dep_cache = self.dependency_cache() if use_cache else None
+        return TreeGenerator(self, excludes, jobs, dep_cache).run(port_path)
@@ -23,16 +23,33 @@
 # SUCH DAMAGE.
 
 import argparse
+import asyncio
 import atexit
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
 import locale
 import logging
 import os
 import os.path
 import sys
-
-from bandar import Bandar
-from .archivers import generate_shar, git_list_ports
+import tempfile
+import threading
+import time
+
+from bandar import Bandar, LintResult, OverlaySession, TreeGenerator
+from . import engine, reaper, runner
+from .archivers import (FORMATS, ArchiveManifest, GitBlobReader, archive_key,
+    generate_archive, generate_archive_async, generate_external_shar,
+    git_changed_ports, git_list_ports)
+from .buildlog import BuildLogWatcher
+from .distfiles import DistfileCache, parse_age, parse_size
+from .gitindex import GitIndex
+from .overlay import BACKENDS
+from .plan import DurationHistory
+from .poudriere import PersistentTrees
+from .rdeps import KINDS, ReverseIndex
+from .watch import WATCHERS, changed_ports, changes, get_watcher
 
 Target = namedtuple('Target', ['parser', 'handler', 'help', 'needs_overlay'])
 
@@ -81,11 +98,42 @@ def write(*args):
     sys.stdout.write("".join(args))
     sys.stdout.flush()
 
+def port_args(p, help):
+    p.add_argument('--changed-since', metavar='ref', dest='changed_since',
+        help='Also select ports changed since a git ref, and the dev ports '
+             'that depend on them')
+    p.add_argument('ports', nargs='*', help=help)
+
+def select_ports(args, bandar=None):
+    if len(args.ports) > 0 and args.ports[0] == 'all':
+        return git_list_ports(args.dev_path)
+
+    ports = list(args.ports)
+    if args.changed_since is not None:
+        changed = git_changed_ports(args.dev_path, args.changed_since)
+        # Archives only depend on the port's own files, so without an
+        # overlay to query there are no reverse dependencies to add.
+        if bandar is not None:
+            changed += bandar.reverse_dependencies(changed)
+        ports += [p for p in changed if p not in ports]
+    elif len(ports) == 0:
+        raise ValueError("No ports given; name some ports, provide 'all' or "
+            "use --changed-since")
+    return ports
+
 def archive_args(p):
     p.add_argument('-o', metavar='path', dest='output_path',
         help='Output path (default: relevant port directory)')
-    p.add_argument('ports', nargs='+',
-        help="Ports to be archived, provide 'all' to generate all")
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int, default=1,
+        help='Number of archives to build concurrently (default: 1)')
+    p.add_argument('-f', metavar='format', dest='format', default='shar',
+        choices=FORMATS, help='Archive format: %s (default: shar)' %
+        ", ".join(FORMATS))
+    p.add_argument('--force', action='store_true',
+        help="Rebuild archives even if their port hasn't changed")
+    p.add_argument('--shar-cmd', action='store_true', dest='external',
+        help='Use shar(1) instead of the built-in shar writer')
+    port_args(p, "Ports to be archived, provide 'all' to generate all")
     return p
 
 def archive_handler(args):
@@ -95,20 +143,159 @@ def archive_handler(args):
         os.makedirs(args.output_path, exist_ok=True)
         out = args.output_path
 
-    if args.ports[0] == 'all':
-        ports = git_list_ports(args.dev_path)
-    else:
-        ports = args.ports
+    if args.external and args.format != 'shar':
+        print("[!] ERROR: --shar-cmd only writes shar archives.")
+        return 1
+
+    ports = select_ports(args)
+    index = GitIndex.load(args.dev_path)
+
+    # One `git cat-file` per worker thread, shared by all its archives
+    local = threading.local()
+    readers = []
+
+    # One manifest per output directory
+    manifests = {}
+    lock = threading.Lock()
+
+    def manifest(path):
+        with lock:
+            d = os.path.dirname(path)
+            if d not in manifests:
+                manifests[d] = ArchiveManifest(d)
+            return manifests[d]
 
-    for port in ports:
-        fn = '%s.shar' % port.replace("/", "_")
-        write('[-] ', port, " -> ")
+    def archive(port):
+        fn = '%s.%s' % (port.replace("/", "_"), args.format)
         if out is None:
-            shar_path = os.path.join(args.dev_path, port, fn)
+            archive_path = os.path.join(args.dev_path, port, fn)
         else:
-            shar_path = os.path.join(out, fn)
-        generate_shar(args.dev_path, port, shar_path)
-        print(shar_path)
+            archive_path = os.path.join(out, fn)
+
+        # shar(1) reads the working tree, which the index can't vouch for.
+        if args.external:
+            generate_external_shar(args.dev_path, port, archive_path)
+            return archive_path, True
+
+        entries = index.files(port)
+        key = archive_key(entries, args.format)
+        m = manifest(archive_path)
+        if not args.force and m.fresh(archive_path, key):
+            return archive_path, False
+
+        if not hasattr(local, 'reader'):
+            local.reader = GitBlobReader(args.dev_path)
+            readers.append(local.reader)
+        generate_archive(args.dev_path, port, archive_path, args.format,
+            entries, local.reader)
+        m.update(archive_path, key)
+        return archive_path, True
+
+    built = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = [pool.submit(archive, port) for port in ports]
+            for port, future in zip(ports, futures):
+                write('[-] ', port, " -> ")
+                path, changed = future.result()
+                built += changed
+                print(path if changed else "%s (unchanged)" % path)
+    finally:
+        for reader in readers:
+            reader.close()
+        for m in manifests.values():
+            m.save()
+
+    print("%d of %d archives rebuilt" % (built, len(ports)), file=sys.stderr)
+
+def check_args(p):
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int,
+        help='Number of processes to run at once, across every stage '
+             '(default: number of CPUs)')
+    p.add_argument('-o', metavar='path', dest='output_path',
+        help='Also archive each port into this directory')
+    p.add_argument('-f', metavar='format', dest='format', default='shar',
+        choices=FORMATS, help='Archive format: %s (default: shar)' %
+        ", ".join(FORMATS))
+    p.add_argument('--no-cache', action='store_false', dest='use_cache',
+        help='Ignore the dependency and lint caches')
+    p.add_argument('--fast', action='store_true', dest='fast',
+        help='Read simple Makefiles directly, only running `make` for ports '
+             'that need it')
+    port_args(p, "Ports to be checked, provide 'all' to check all")
+    return p
+
+async def check_ports(args, bandar, ports):
+    # Every port's dependency walk, portlint run and archive are in flight
+    # at once, sharing the engine's limit, rather than one stage at a time.
+    eng = engine.Engine(args.jobs)
+    dep_cache = bandar.dependency_cache() if args.use_cache else None
+    lint_cache = bandar.lint_cache() if args.use_cache else None
+    lint_keys = lint_cache.keys(ports, ('-gAC',)) if lint_cache else {}
+    evaluator = bandar.makefile_evaluator() if args.fast else None
+    gen = TreeGenerator(bandar, dep_cache=dep_cache, evaluator=evaluator)
+    index = GitIndex.load(args.dev_path)
+
+    async def tree(port):
+        # Saving the caches is left until every walk is done.
+        await gen.walk_async(eng, port)
+        graph = gen.make_graph(port)
+        return len(graph) - 1, graph.find_cycles(port)
+
+    async def lint(port):
+        if lint_cache is not None:
+            data = lint_cache.get(lint_keys[port])
+            if data is not None:
+                return LintResult(**data)
+        res = await bandar.lint_port_async(eng, port, '-gAC')
+        if lint_cache is not None:
+            lint_cache.put(lint_keys[port], dict(res._asdict()))
+        return res
+
+    async def archive(port):
+        if args.output_path is None:
+            return None
+        path = os.path.join(args.output_path, '%s.%s' % (port.replace("/", "_"),
+            args.format))
+        await generate_archive_async(eng, args.dev_path, port, path,
+            args.format, index.files(port))
+        return path
+
+    async def check(port):
+        return await asyncio.gather(tree(port), lint(port), archive(port))
+
+    if args.output_path is not None:
+        os.makedirs(args.output_path, exist_ok=True)
+
+    tasks = [asyncio.ensure_future(check(port)) for port in ports]
+    ret = 0
+    with gen.saving():
+        try:
+            for port, task in zip(ports, tasks):
+                (ndeps, cycles), res, path = await task
+                failed = len(cycles) > 0 or len(res.errors) > 0
+                write('[-] %s -> ' % port)
+                print("%s (%d dependencies)" % (failure() if failed or
+                    len(res.warnings) else success(), ndeps))
+                for cycle in cycles:
+                    print("Dependency cycle: %s" % " -> ".join(cycle))
+                if len(res.errors) or len(res.warnings):
+                    print("\n".join(res.errors + res.warnings))
+                if path is not None:
+                    print("    %s" % path)
+                if failed:
+                    ret = 1
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    if evaluator is not None:
+        print_fast_path(evaluator, gen.port_query)
+    return ret
+
+def check_handler(args, bandar):
+    ports = select_ports(args, bandar)
+    return engine.run(check_ports(args, bandar, ports))
 
 def check_git_args(p):
     return p
@@ -141,92 +328,551 @@ def diff_args(p):
 def diff_handler(args):
     pass
 
+def overlay_args(p):
+    p.add_argument('action', choices=['up', 'down', 'status', 'reap'],
+        help='Mount, unmount or inspect the persistent overlay, or clean up '
+             'overlays left behind by crashed runs')
+    return p
+
+def overlay_handler(args):
+    session = OverlaySession([args.dev_path, args.ports_path])
+
+    if args.action == 'up':
+        overlay = session.up(backend=args.backend or 'unionfs')
+        if args.backend and overlay.backend.name != args.backend:
+            print("[!] WARN: Session already up with the '%s' backend" %
+                overlay.backend.name)
+        print("[-] Overlay mounted at %s" % overlay.mountpoint)
+    elif args.action == 'reap':
+        for path in reaper.sweep():
+            print("[-] Removed %s" % path)
+    elif args.action == 'down':
+        if session.down():
+            print("[-] Overlay unmounted")
+        else:
+            print("[-] No overlay session is running")
+    else:
+        state = session.status()
+        if state is None:
+            print("[-] No overlay session is running")
+            return 1
+        print("[-] Mountpoint: %s" % state['mountpoint'])
+        print("[-] Workspace: %s" % state['workspace'])
+        print("[-] Layers: %s" % ", ".join(state['layers']))
+        print("[-] Backend: %s" % state.get('backend', 'unionfs'))
+        if not state['live']:
+            print("[!] WARN: stale session, the overlay is no longer mounted")
+            return 1
+
 def poudriere_args(p):
-    p.add_argument('-j', metavar='jail', dest='jail', required=True,
-        help='Jail to use for build')
-    p.add_argument('ports', nargs='+',
-        help="Ports to be archived, provide 'all' to generate all")
+    p.add_argument('-j', metavar='jail', dest='jails', action='append',
+        required=True,
+        help='Jail to use for build; repeat to build in several jails')
+    p.add_argument('-J', metavar='jobs', dest='jobs', type=int,
+        help='Number of jails to build in at once (default: all of them)')
+    p.add_argument('-l', metavar='log-dir', dest='log_dir',
+        help='Directory for per-jail logs when building in several jails')
+    p.add_argument('-P', action='store_true', dest='persistent',
+        help='Build in a persistent ports tree on the overlay session, '
+             'reused across runs')
+    p.add_argument('-n', metavar='name', dest='tree_name',
+        help='Name of the persistent ports tree (default: derived from the '
+             'overlay layers)')
+    p.add_argument('-t', metavar='path', dest='timings_path',
+        help='Follow the build logs and save per-port phase timings as JSON')
+    p.add_argument('--no-plan', action='store_false', dest='plan',
+        help='Queue ports in the order given instead of longest dependency '
+             'chains first')
+    port_args(p, "Ports to be archived, provide 'all' to generate all")
     return p
 
+def print_build_summary(jail, summary):
+    print(file=sys.stderr)
+    print("%s: slowest ports:" % jail, file=sys.stderr)
+    for p in summary['slowest_ports']:
+        print("  %8.1fs  %s (%s)" % (p['seconds'], p['origin'], p['status']),
+            file=sys.stderr)
+    print("%s: slowest phases:" % jail, file=sys.stderr)
+    for p in summary['slowest_phases']:
+        print("  %8.1fs  %s %s" % (p['seconds'], p['origin'], p['phase']),
+            file=sys.stderr)
+
+def save_build_summaries(path, builds):
+    history = DurationHistory()
+    out = []
+    for jail, build, watcher in builds:
+        summary = watcher.summary()
+        print_build_summary(jail, summary)
+        out.append(dict(summary, jail=jail, build=build))
+        for p in summary['ports']:
+            if p['origin'] is not None and p['elapsed'] is not None:
+                history.record('build', p['origin'], p['elapsed'])
+    history.save()
+    with open(path, 'w') as f:
+        json.dump({'builds': out}, f, indent=2)
+        f.write('\n')
+
+def bulk_status_printer():
+    # Redraws the table in place on a terminal; elsewhere, prints a line
+    # whenever a jail changes state.
+    tty = sys.stdout.isatty()
+    shown = {}
+    drawn = [0]
+
+    def update(runs):
+        if not tty:
+            for run in runs:
+                if shown.get(run.jail) != run.state:
+                    shown[run.jail] = run.state
+                    print("[-] %s: %s (%.0fs)" % (run.jail, run.state,
+                        run.elapsed))
+            return
+
+        lines = ["%-20s %-10s %8s  %s" % ('JAIL', 'STATE', 'ELAPSED', 'LOG')]
+        for run in runs:
+            lines.append("%-20s %-10s %7.0fs  %s" % (run.jail, run.state,
+                run.elapsed, run.log_path))
+        if drawn[0] > 0:
+            write("\033[%dA" % drawn[0])
+        write("".join("\033[K%s\n" % line for line in lines))
+        drawn[0] = len(lines)
+    return update
+
 def poudriere_handler(args, bandar):
-    if args.ports[0] == 'all':
-        ports = git_list_ports(args.dev_path)
-    else:
-        ports = args.ports
+    ports = select_ports(args, bandar)
+    persistent = args.persistent or args.tree_name is not None
+    if args.plan and len(ports) > 1:
+        ports = bandar.build_plan(ports, 'build').order()
+
+    watch = args.timings_path is not None
+
+    if len(args.jails) == 1:
+        watcher = BuildLogWatcher() if watch else None
+        build = bandar.bulk_build(args.jails[0], ports, persistent,
+            args.tree_name, watcher)
+        print(build)
+        if watch:
+            save_build_summaries(args.timings_path,
+                [(args.jails[0], build, watcher)])
+        return
+
+    runs = bandar.bulk_build_many(args.jails, ports, args.jobs, args.log_dir,
+        bulk_status_printer(), persistent, args.tree_name, watch)
+
+    ret = 0
+    for run in runs:
+        print("%s: %s" % (run.jail, run.build))
+        if run.state != 'done':
+            ret = 1
+    if watch:
+        save_build_summaries(args.timings_path,
+            [(run.jail, run.build, run.watcher) for run in runs])
+    return ret
+
+def poudriere_trees_args(p):
+    p.add_argument('action', choices=['list', 'prune'],
+        help='List the persistent poudriere ports trees, or delete those '
+             'whose overlay session is gone or has changed')
+    return p
+
+def poudriere_trees_handler(args):
+    trees = PersistentTrees()
+
+    if args.action == 'prune':
+        for name in trees.prune():
+            print("[-] Deleted ports tree %s" % name)
+        return
+
+    for record in trees.records():
+        print("%s: %s (%s)" % (record['name'], record['mountpoint'],
+            ", ".join(record['layers'])))
+
+def rdeps_args(p):
+    p.add_argument('-k', action='append', metavar='kind', dest='kinds',
+        choices=KINDS,
+        help='Dependency kind to follow: %s (default: all)' % ', '.join(KINDS))
+    p.add_argument('-1', action='store_false', dest='transitive',
+        help='Only list direct dependents')
+    p.add_argument('--generate', action='store_true',
+        help='Run `make index` in the ports tree if it has no INDEX file')
+    p.add_argument('ports', nargs='+',
+        help='Ports whose upstream dependents shall be listed')
+    return p
 
-    print(bandar.bulk_build(args.jail, ports))
+def rdeps_handler(args):
+    index = ReverseIndex.for_ports(args.ports_path, args.generate)
+    for port in args.ports:
+        rdeps = index.rdeps(port, args.kinds, args.transitive)
+        if len(args.ports) > 1:
+            print("%s:" % port)
+            rdeps = ["  %s" % x for x in rdeps]
+        if len(rdeps) > 0:
+            print("\n".join(rdeps))
 
 def test_args(p):
-    p.add_argument('ports', nargs='+',
-        help="Ports to be tested, provide 'all' to test all")
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int, default=1,
+        help='Number of isolated test workers (default: 1)')
+    p.add_argument('-l', metavar='log-dir', dest='log_dir',
+        help='Directory for per-port test logs (default: a new temporary '
+             'directory when running more than one worker)')
+    p.add_argument('--no-plan', action='store_false', dest='plan',
+        help='Test in the order given instead of dependencies first, and '
+             "don't skip the dependents of a failed port")
+    port_args(p, "Ports to be tested, provide 'all' to test all")
     return p
 
-def test_handler(args, bandar):
-    if args.ports[0] == 'all':
-        ports = git_list_ports(args.dev_path)
+def print_test_result(res):
+    if res.skipped:
+        print('[-] %s -> %s (skipped, a dependency failed)' % (res.port,
+            failure()))
     else:
-        ports = args.ports
+        print('[-] %s -> %s (%.1fs)' % (res.port,
+            success() if res.passed else failure(), res.elapsed))
 
-    bandar.test_ports(ports)
-    print("Please wait, unmounting overlay...", file=sys.stderr)
+def test_handler(args, bandar):
+    ports = select_ports(args, bandar)
+
+    log_dir = args.log_dir
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+    elif args.jobs > 1:
+        log_dir = tempfile.mkdtemp(prefix='bandar-logs-')
+    if log_dir is not None:
+        print("[-] Logs: %s" % log_dir)
+
+    plan = None
+    if args.plan and len(ports) > 1:
+        plan = bandar.build_plan(ports, 'test')
+
+    history = DurationHistory()
+    ret = 0
+    try:
+        for res in bandar.iter_test_ports(ports, args.jobs, log_dir, plan):
+            print_test_result(res)
+            if not res.skipped:
+                history.record('test', res.port, res.elapsed)
+            if not res.passed:
+                ret = 1
+    finally:
+        history.save()
+
+    return ret
+
+def plan_args(p):
+    p.add_argument('-k', metavar='kind', dest='kind', default='test',
+        choices=['test', 'build'],
+        help='Whose past durations to plan with: test or build '
+             '(default: test)')
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int,
+        help='Number of concurrent `make` queries (default: number of CPUs)')
+    p.add_argument('--no-cache', action='store_false', dest='use_cache',
+        help='Ignore the persistent dependency cache and query every port')
+    p.add_argument('--fast', action='store_true', dest='fast',
+        help='Read simple Makefiles directly, only running `make` for ports '
+             'that need it')
+    p.add_argument('-f', metavar='format', dest='format', default='text',
+        choices=['text', 'json'],
+        help='Output format: text or json (default: text)')
+    port_args(p, "Ports to be planned, provide 'all' to plan all")
+    return p
+
+def plan_handler(args, bandar):
+    ports = select_ports(args, bandar)
+    evaluator = bandar.makefile_evaluator() if args.fast else None
+    plan = bandar.build_plan(ports, args.kind, args.jobs, args.use_cache,
+        evaluator)
+    data = plan.to_dict()
+
+    if args.format == 'json':
+        json.dump(data, sys.stdout, indent=2)
+        print()
+        return
+
+    for i, wave in enumerate(data['waves']):
+        print("Wave %d (%d ports):" % (i + 1, len(wave)))
+        for p in wave:
+            print("  %8.1fs%s %s" % (p['seconds'], '*' if p['estimated']
+                else ' ', p['origin']))
+    print()
+    print("Critical path: %.1fs of %.1fs total" % (data['critical_seconds'],
+        data['total_seconds']))
+    print("  %s" % " -> ".join(data['critical_path']))
+    if any(p['estimated'] for wave in data['waves'] for p in wave):
+        print("(* no %s history; estimated)" % args.kind)
+    for port, dep in data['broken_edges']:
+        print("[!] WARN: dependency cycle; %s started before %s" % (port, dep),
+            file=sys.stderr)
 
 def tree_args(p):
     p.add_argument('port', help="Port for which a tree shall be printed")
     p.add_argument('-x', action='append', metavar='exclude-port', default=[],
         dest='excludes', help='Ports to be excluded from the tree')
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int, default=1,
+        help='Number of concurrent `make` queries (default: 1)')
+    p.add_argument('-t', action='store_true', dest='timings',
+        help='Print per-port query latency, slowest first')
+    p.add_argument('--no-cache', action='store_false', dest='use_cache',
+        help='Ignore the persistent dependency cache and query every port')
+    p.add_argument('--fast', action='store_true', dest='fast',
+        help='Read simple Makefiles directly, only running `make` for ports '
+             'that need it')
+    p.add_argument('--verify', action='store_true', dest='verify',
+        help='With --fast, also run `make` for every port and report any '
+             'port the Makefile reader got wrong')
+    p.add_argument('-f', metavar='format', dest='format', default='text',
+        choices=['text', 'json', 'dot'],
+        help='Output format: text, json or dot (default: text)')
     return p
 
-def print_tree(nodes, depth=-1, prefix=None):
-    if prefix is None:
-        prefix = []
-
-    last = len(nodes) - 1
-    for i, node in enumerate(nodes):
-        p = prefix[:]
-        if depth == -1:
-            print(node[0])
-        elif i == last:
-            print('%s %s%s%s' % (''.join(prefix), leaf_end(), leaf_arm(), node[0]))
-            p.append('   ')
+def print_graph(graph, root):
+    expanded = set()
+    active = set()
+    stack = [(graph.index[root], None, True)]
+
+    while stack:
+        node, prefix, last = stack.pop()
+        if last is None:
+            active.discard(node)
+            continue
+
+        children = graph.edges[node]
+        mark = ''
+        if node in active:
+            mark = ' (cycle)'
+        elif node in expanded and len(children) > 0:
+            mark = ' (*)'
+
+        if prefix is None:
+            print(graph.names[node])
+            child_prefix = ''
+        elif last:
+            print('%s %s%s%s%s' % (prefix, leaf_end(), leaf_arm(),
+                graph.names[node], mark))
+            child_prefix = prefix + '   '
         else:
-            print('%s %s%s%s' % (''.join(prefix), leaf(), leaf_arm(), node[0]))
-            p.append(' %s ' % pipe())
-
-        print_tree(node[1], depth + 1, p)
+            print('%s %s%s%s%s' % (prefix, leaf(), leaf_arm(),
+                graph.names[node], mark))
+            child_prefix = prefix + ' %s ' % pipe()
+
+        if node in expanded:
+            continue
+        expanded.add(node)
+        active.add(node)
+
+        # Children are pushed in reverse so they pop in order, after a
+        # marker that takes this node off the active path again.
+        stack.append((node, None, None))
+        for i in reversed(range(len(children))):
+            stack.append((children[i], child_prefix, i == len(children) - 1))
+
+def print_timings(timings):
+    total = sum(timings.values())
+    print(file=sys.stderr)
+    print("%d queries, %.2fs total:" % (len(timings), total), file=sys.stderr)
+    for port, elapsed in sorted(timings.items(), key=lambda x: -x[1]):
+        print("  %8.3fs  %s" % (elapsed, port), file=sys.stderr)
+
+def print_fast_path(evaluator, port_query):
+    print("fast path: %d read, %d left to make (%.0f%% hit rate)" % (
+        evaluator.hits, evaluator.misses, evaluator.hit_rate * 100),
+        file=sys.stderr)
+    for fast, info in port_query.mismatches:
+        print("[!] %s: Makefile reader disagrees with make" % info.origin,
+            file=sys.stderr)
+        for field in info._fields[1:]:
+            if getattr(fast, field) != getattr(info, field):
+                print("      %s: %r != %r" % (field, getattr(fast, field),
+                    getattr(info, field)), file=sys.stderr)
 
 def tree_handler(args, bandar):
     port = args.port
+    out = sys.stdout if args.format == 'text' else sys.stderr
     if len(args.excludes) > 0:
-        print("The following ports were not included in the tree:")
-        print("  %s" % "\n  ".join(args.excludes))
+        print("The following ports were not included in the tree:", file=out)
+        print("  %s" % "\n  ".join(args.excludes), file=out)
+        print(file=out)
+
+    dep_cache = bandar.dependency_cache() if args.use_cache else None
+    fast = args.fast or args.verify
+    evaluator = bandar.makefile_evaluator() if fast else None
+    gen = TreeGenerator(bandar, args.excludes, args.jobs, dep_cache,
+        evaluator=evaluator, verify=args.verify)
+    graph = gen.graph(port)
+
+    if args.format == 'json':
+        json.dump(graph.to_dict(port), sys.stdout, indent=2)
         print()
-    tree = bandar.generate_dependency_tree(port, args.excludes)
-
-    print_tree([(port, tree)])
-
-    print("Please wait, unmounting overlay...", file=sys.stderr)
+    elif args.format == 'dot':
+        for line in graph.iter_dot(port):
+            print(line)
+    else:
+        print_graph(graph, port)
+        for cycle in graph.find_cycles(port):
+            print("[!] WARN: dependency cycle: %s" % " -> ".join(cycle),
+                file=sys.stderr)
+
+    if args.timings:
+        print_timings(gen.timings)
+        if dep_cache is not None:
+            print("cache: %d hits, %d misses" % (dep_cache.hits,
+                dep_cache.misses), file=sys.stderr)
+
+    if evaluator is not None:
+        print_fast_path(evaluator, gen.port_query)
+        if args.verify and len(gen.port_query.mismatches) > 0:
+            return 1
 
 def lint_args(p):
-    p.add_argument('ports', nargs='+',
-        help="Ports to be tested, provide 'all' to test all")
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int, default=1,
+        help='Number of concurrent `portlint` processes (default: 1)')
+    p.add_argument('--no-cache', action='store_false', dest='use_cache',
+        help='Run portlint even on ports whose inputs are unchanged')
+    port_args(p, "Ports to be tested, provide 'all' to test all")
     return p
 
-def lint_handler(args, bandar):
-    if args.ports[0] == 'all':
-        ports = git_list_ports(args.dev_path)
-    else:
-        ports = args.ports
-
-    for port in ports:
+def print_lint_results(results):
+    ret = 0
+    for port, res in results:
         write('[-] %s -> ' % port)
-        res = bandar.lint_port(port, '-gAC')
         if len(res.warnings) or len(res.errors):
             print(failure())
             print("\n".join(res.errors + res.warnings))
         else:
             print(success())
+        if len(res.errors):
+            ret = 1
+    return ret
+
+def lint_handler(args, bandar):
+    ports = select_ports(args, bandar)
+
+    lint_cache = bandar.lint_cache() if args.use_cache else None
+
+    ret = print_lint_results(bandar.lint_ports(ports, '-gAC', jobs=args.jobs,
+                                               lint_cache=lint_cache))
 
-    print("Please wait, unmounting overlay...", file=sys.stderr)
+    if lint_cache is not None:
+        print("cache: %d hits, %d misses (%.0f%% hit rate)" % (lint_cache.hits,
+            lint_cache.misses, lint_cache.hit_rate * 100), file=sys.stderr)
+    return ret
+
+def human_size(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TiB'
+    return "%.1f %s" % (n, unit) if unit != 'B' else "%d B" % n
+
+def print_distfile_stats(cache):
+    if cache is None or cache.hits + cache.misses == 0:
+        return
+    print("distfiles: %d hits, %d misses, %s not fetched" % (cache.hits,
+        cache.misses, human_size(cache.bytes_saved)), file=sys.stderr)
+
+def distfiles_args(p):
+    p.add_argument('action', choices=['status', 'evict'],
+        help="Show the size of bandar's distfile cache, or evict from it")
+    p.add_argument('--max-size', metavar='size', dest='max_size',
+        type=parse_size,
+        help='Evict the least recently used distfiles until the cache is '
+             'at most this size, e.g. 20G')
+    p.add_argument('--max-age', metavar='age', dest='max_age',
+        type=parse_age,
+        help='Evict distfiles unused for this long, e.g. 90d (default unit: '
+             'days)')
+    return p
+
+def distfiles_handler(args):
+    cache = DistfileCache()
+    if args.action == 'evict':
+        if args.max_size is None and args.max_age is None:
+            raise ValueError("Give --max-size, --max-age or both")
+        removed = cache.evict(args.max_size, args.max_age)
+        print("[-] Evicted %d distfiles, %s" % (len(removed),
+            human_size(sum(size for _, size in removed))))
+
+    status = cache.status()
+    print("%s: %d distfiles, %s" % (status['path'], status['files'],
+        human_size(status['bytes'])))
+
+def watch_args(p):
+    p.add_argument('-j', metavar='jobs', dest='jobs', type=int, default=1,
+        help='Number of concurrent `portlint` processes (default: 1)')
+    p.add_argument('-t', action='store_true', dest='test',
+        help='Also run `port test` on each changed port, one at a time')
+    p.add_argument('--no-lint', action='store_false', dest='lint',
+        help="Don't run `portlint` on changed ports")
+    p.add_argument('-w', metavar='watcher', dest='watcher',
+        choices=sorted(WATCHERS),
+        help='How to watch for changes: %s (default: the first of kqueue, '
+             'inotify and poll available)' % ", ".join(sorted(WATCHERS)))
+    p.add_argument('--delay', metavar='seconds', dest='delay', type=float,
+        default=0.1,
+        help='How long the tree must be quiet before a run (default: 0.1)')
+    p.add_argument('--no-cache', action='store_false', dest='use_cache',
+        help='Ignore the lint cache')
+    port_args(p, "Ports to be watched (default: all)")
+    return p
+
+def watch_burst(args, bandar, changed, lint_cache):
+    # Errors are reported and the session carries on; only Ctrl-C ends it.
+    try:
+        bandar.overlay.refresh()
+        if args.lint:
+            print_lint_results(bandar.lint_ports(changed, '-gAC',
+                jobs=args.jobs, lint_cache=lint_cache))
+    except Exception as e:
+        print("[!] ERROR: %s" % e)
+        return
+
+    if args.test:
+        for port in changed:
+            try:
+                print_test_result(bandar.test_port(port))
+            except Exception as e:
+                print("[!] ERROR: %s: %s" % (port, e))
+
+def watch_handler(args, bandar):
+    # One overlay and one lint cache for the whole session; every burst of
+    # changes only lints and tests the ports it touched.  Tests run serially
+    # on that overlay, as workers would each mount one of their own.
+    # Without any ports, every port in the tree is watched.
+    ports = None
+    if len(args.ports) > 0 and args.ports[0] != 'all' or \
+            args.changed_since is not None:
+        ports = set(select_ports(args, bandar))
+    lint_cache = bandar.lint_cache() if args.use_cache else None
+
+    watcher = get_watcher(args.watcher)
+    watcher.start(bandar.proj_dir)
+    print("[-] Watching %s (%s); press Ctrl-C to stop" % (bandar.proj_dir,
+        watcher.name))
+
+    try:
+        for paths in changes(watcher, args.delay):
+            changed = changed_ports(paths, bandar.proj_dir, ports)
+            if len(changed) == 0:
+                continue
+
+            # A watched port may have been deleted since.
+            removed = [p for p in changed if not os.path.isdir(
+                os.path.join(bandar.proj_dir, p))]
+            if len(removed) > 0:
+                print("[-] Removed: %s" % ", ".join(removed))
+                changed = [p for p in changed if p not in removed]
+                if len(changed) == 0:
+                    continue
+
+            start = time.monotonic()
+            print("[-] Changed: %s" % ", ".join(changed))
+            watch_burst(args, bandar, changed, lint_cache)
+            print("[-] Done in %.1fs" % (time.monotonic() - start))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 commands = {
     'archive': Target(archive_args, archive_handler,
@@ -234,18 +880,47 @@ commands = {
         False),
     #'diff': Target(diff_args, diff_handler,
     #    'Generate diff patches', False),
+    'distfiles': Target(distfiles_args, distfiles_handler,
+        "Show or evict from bandar's shared distfile cache", False),
     'lint': Target(lint_args, lint_handler,
         'Run `portlint` on development ports', True),
     'tree': Target(tree_args, tree_handler,
         'Print dependency tree for a port', True),
+    'overlay': Target(overlay_args, overlay_handler,
+        'Manage a persistent overlay reused by later commands', False),
+    'plan': Target(plan_args, plan_handler,
+        'Print the order to build development ports in, and the critical path',
+        True),
     'poudriere': Target(poudriere_args, poudriere_handler,
         'Run `poudriere` on development ports', True),
+    'poudriere-trees': Target(poudriere_trees_args, poudriere_trees_handler,
+        'List or prune persistent poudriere ports trees', False),
+    'rdeps': Target(rdeps_args, rdeps_handler,
+        'List upstream ports depending on a port, using the ports INDEX',
+        False),
     'test': Target(test_args, test_handler,
         'Run `port test` on development ports', True),
+    'watch': Target(watch_args, watch_handler,
+        'Lint (and test) development ports again whenever they change', True),
+    'check': Target(check_args, check_handler,
+        'Walk dependencies, lint and archive development ports, all at once',
+        True),
     'check-git': Target(check_git_args, check_git_handler,
         'Check your git repo is configured optimally', False)
 }
 
+def write_profile(path):
+    runner.PROFILER.write_trace(path)
+
+    rows = runner.PROFILER.summary()
+    print(file=sys.stderr)
+    print("%-16s %6s %10s %10s %12s %6s" % ('command', 'calls', 'wall', 'cpu',
+        'output', 'failed'), file=sys.stderr)
+    for name, count, wall, cpu, nbytes, failed in rows:
+        print("%-16s %6d %9.3fs %9.3fs %12d %6d" % (name, count, wall, cpu,
+            nbytes, failed), file=sys.stderr)
+    print("Trace written to %s" % path, file=sys.stderr)
+
 def main():
     p = argparse.ArgumentParser(prog='bandar')
 
@@ -255,6 +930,17 @@ def main():
     p.add_argument('-p', metavar='ports-path', dest='ports_path',
         default='/usr/ports',
         help='Directory of upstream ports (default: /usr/ports)')
+    p.add_argument('-b', metavar='backend', dest='backend', default=None,
+        choices=sorted(BACKENDS),
+        help='Overlay backend: %s (default: a running session\'s, '
+            'else unionfs)' % ', '.join(sorted(BACKENDS)))
+
+    p.add_argument('--no-distfiles', action='store_false', dest='distfiles',
+        help="Don't share fetched distfiles between runs through bandar's "
+             'distfile cache')
+    p.add_argument('--profile', metavar='path', dest='profile_path',
+        help='Record every command and overlay operation, write them to '
+             'path as a Chrome trace and print a summary')
 
     sub = p.add_subparsers(dest='command')
     for k, target in sorted(commands.items()):
@@ -263,6 +949,11 @@ def main():
     args = p.parse_args()
     logger.debug(args)
 
+    # Registered first so it runs after every overlay's own teardown.
+    if args.profile_path is not None:
+        runner.enable_profiling()
+        atexit.register(write_profile, args.profile_path)
+
     if args.command is None:
         p.print_help()
         sys.exit(0)
@@ -271,8 +962,11 @@ def main():
 
     try:
         if cmd.needs_overlay:
-            bandar = Bandar(args.dev_path, args.ports_path)
+            bandar = Bandar(args.dev_path, args.ports_path,
+                backend=args.backend,
+                distfiles=DistfileCache() if args.distfiles else None)
             ret = cmd.handler(args, bandar)
+            print_distfile_stats(bandar.distfiles)
         else:
             ret = cmd.handler(args)
         sys.exit(0 if ret is None else ret)
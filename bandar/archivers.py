@@ -22,15 +22,34 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
+from contextlib import suppress
+import hashlib
+import io
+import json
+import os
 import os.path
 import subprocess
+import tarfile
+import threading
+
+from . import runner
+from .cache import atomic_write_json, cache_dir, digest
+from .gitindex import GitIndex
+
+def git_list_ports(path):
+    return GitIndex.load(path).ports()
+
+def git_changed_ports(path, ref):
+    # Ports touched since `ref`, including uncommitted and untracked files.
+    diff = runner.check_output(['git', 'diff', '--name-only', '-z', ref,
+        '--'], cwd=path)
+    untracked = runner.check_output(['git', 'ls-files', '--others',
+        '--exclude-standard', '-z'], cwd=path)
 
-def git_list_ports(path, *args, **kwargs):
-    files = git_ls_files(path, *args, **kwargs)
     o = set()
-    for fn in files:
-        chunks = fn.split('/')
-        if len(chunks) < 2:
+    for fn in (diff + untracked).split(b'\x00')[:-1]:
+        chunks = fn.decode().split('/')
+        if len(chunks) < 3:
             continue
         port = "/".join(chunks[:2])
 
@@ -41,12 +60,199 @@ def git_list_ports(path, *args, **kwargs):
 def git_ls_files(path, *args, **kwargs):
     if 'cwd' not in kwargs:
         kwargs['cwd'] = path
-    data = subprocess.check_output(['git', 'ls-files', '-z', path],
+    data = runner.check_output(['git', 'ls-files', '-z', path],
         *args, **kwargs)
     return [x.decode() for x in data.split(b'\x00')[:-1]]
 
-def generate_shar(git_root, path, output_path):
+class GitBlobReader:
+    # Streams blobs out of one long-running `git cat-file --batch`.
+    def __init__(self, git_root):
+        self.proc = runner.Popen(['git', 'cat-file', '--batch'],
+            cwd=git_root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, sha):
+        self.proc.stdin.write(sha.encode() + b'\n')
+        self.proc.stdin.flush()
+
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise ValueError("git object '%s' is missing!" % sha)
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+SHAR_HEADER = b"""\
+# This is a shell archive.  Save it in a file, remove anything before
+# this line, and then unpack it by entering "sh file".  Note, it may
+# create directories; files and directories will be owned by you and
+# have default permissions.
+#
+# This archive contains:
+#
+"""
+
+FORMATS = ['shar', 'tar.xz', 'tar.zst']
+
+# Both compress with every core and read the tar stream from a pipe.
+COMPRESSORS = {
+    'tar.xz': ['xz', '-T0', '-c'],
+    'tar.zst': ['zstd', '-T0', '-q', '-c'],
+}
+
+
+def archive_members(entries):
+    # Every file, preceded by each directory leading to it, like the
+    # output of `find`.
+    seen = set()
+    for mode, sha, fn in sorted(entries, key=lambda x: x[2]):
+        chunks = fn.split('/')
+        for i in range(1, len(chunks)):
+            d = '/'.join(chunks[:i])
+            if d not in seen:
+                seen.add(d)
+                yield d, None, None
+        yield fn, mode, sha
+
+def write_shar(f, entries, read):
+    # Submodules have no blob to write, as in write_tar.
+    members = [m for m in archive_members(entries) if m[1] != '160000']
+
+    f.write(SHAR_HEADER)
+    f.write(b''.join(b'#\t%s\n' % fn.encode() for fn, _, _ in members))
+    f.write(b'#\n')
+
+    for fn, mode, sha in members:
+        name = fn.encode()
+        if sha is None:
+            f.write(b"echo c - '%s'\nmkdir -p '%s' > /dev/null 2>&1\n" %
+                (name, name))
+            continue
+
+        lines = read(sha).split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        f.write(b"echo x - '%s'\nsed 's/^X//' >'%s' << 'END-of-%s'\n" %
+            (name, name, name))
+        f.write(b''.join(b'X' + line + b'\n' for line in lines))
+        f.write(b'END-of-%s\n' % name)
+
+    f.write(b'exit\n\n')
+
+def write_tar(f, entries, read):
+    # mtimes are left at zero so that the same tree always gives the same
+    # archive.
+    with tarfile.open(fileobj=f, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        for fn, mode, sha in archive_members(entries):
+            info = tarfile.TarInfo(fn)
+            if sha is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif mode == '120000':
+                info.type = tarfile.SYMTYPE
+                info.linkname = read(sha).decode()
+                tar.addfile(info)
+            elif mode != '160000':
+                data = read(sha)
+                info.mode = int(mode, 8) & 0o777
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+def write_compressed_tar(f, fmt, entries, read):
+    proc = runner.Popen(COMPRESSORS[fmt], stdin=subprocess.PIPE, stdout=f)
+    try:
+        write_tar(proc.stdin, entries, read)
+    finally:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode,
+                COMPRESSORS[fmt][0])
+
+def generate_archive(git_root, path, output_path, fmt='shar', entries=None,
+                     reader=None):
+    if entries is None:
+        entries = GitIndex.load(git_root).files(path)
+
+    def write(f, read):
+        if fmt == 'shar':
+            write_shar(f, entries, read)
+        else:
+            write_compressed_tar(f, fmt, entries, read)
+
+    tmp_path = output_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            if reader is None:
+                with GitBlobReader(git_root) as reader:
+                    write(f, reader.read)
+            else:
+                write(f, reader.read)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+
+async def generate_archive_async(engine, git_root, path, output_path,
+                                 fmt='shar', entries=None):
+    await engine.run_blocking(generate_archive, git_root, path, output_path,
+        fmt, entries)
+
+def generate_shar(git_root, path, output_path, entries=None, reader=None):
+    generate_archive(git_root, path, output_path, 'shar', entries, reader)
+
+def generate_external_shar(git_root, path, output_path):
     files = git_ls_files(path, cwd=git_root)
-    data = subprocess.check_output(['shar'] + files, cwd=git_root)
-    with open(output_path, 'wb') as f:
-        f.write(data)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        runner.check_call(['shar'] + files, cwd=git_root, stdout=f)
+    os.replace(tmp_path, output_path)
+
+def archive_key(entries, fmt):
+    # Equivalent to the port's tree hash, but read from the index.
+    h = hashlib.sha1(fmt.encode())
+    for mode, sha, fn in sorted(entries, key=lambda x: x[2]):
+        h.update(b'\x00%s %s %s' % (mode.encode(), sha.encode(), fn.encode()))
+    return h.hexdigest()
+
+class ArchiveManifest:
+    # Records the content key each archive in a directory was built from.
+    # It's kept in the cache rather than next to the archives, which are
+    # often in the ports tree being archived.
+    def __init__(self, path):
+        self.path = os.path.join(cache_dir(), 'archives-%s.json' %
+            digest(os.path.abspath(path))[:16])
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                self.keys = json.load(f)
+        except (OSError, ValueError):
+            self.keys = {}
+
+    def fresh(self, output_path, key):
+        with self.lock:
+            return (self.keys.get(os.path.basename(output_path)) == key and
+                    os.path.isfile(output_path))
+
+    def update(self, output_path, key):
+        with self.lock:
+            self.keys[os.path.basename(output_path)] = key
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        atomic_write_json(self.path, self.keys)
+        self.dirty = False
@@ -0,0 +1,216 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Follows a running poudriere bulk's log directory and times each port's
+# phases. Every file is read incrementally from where the last poll left
+# off; a port's log is dropped once the port has finished.
+#
+# Phase times come from the `[hh:mm:ss]` prefixes poudriere writes with
+# TIMESTAMP_LOGS=yes, and otherwise from when each phase banner was seen.
+
+import os
+import os.path
+import re
+import time
+
+RE_STAMP = re.compile(r'^\[(\d+):(\d\d):(\d\d)\] ')
+RE_PHASE = re.compile(r'^=+<phase: ([\w-]+)\s*>=+$')
+RE_PORTDIR = re.compile(r'^port directory: (.*)$')
+RE_BUILD_TIME = re.compile(r'^build time: (\d+):(\d\d):(\d\d)$')
+
+
+def hms(h, m, s):
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+class FileFollower:
+    # Yields only the complete lines appended since the previous call.
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b''
+
+    def lines(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        self.offset += len(data)
+
+        chunks = (self.partial + data).split(b'\n')
+        self.partial = chunks.pop()
+        return [c.decode(errors='replace') for c in chunks]
+
+
+class PortTiming:
+    def __init__(self, pkgname):
+        self.pkgname = pkgname
+        self.origin = None
+        self.status = 'building'
+        self.phases = {}
+        self.elapsed = None
+        self.failed_phase = None
+        self.__phase = None
+        self.__since = None
+        self.__last = None
+
+    def feed(self, line, now):
+        m = RE_STAMP.match(line)
+        if m is not None:
+            now = hms(*m.groups())
+            line = line[m.end():]
+        self.__last = now
+
+        m = RE_PHASE.match(line)
+        if m is not None:
+            self.close(now)
+            self.__phase = m.group(1)
+            self.__since = now
+            return
+
+        m = RE_PORTDIR.match(line)
+        if m is not None:
+            self.origin = "/".join(m.group(1).rstrip('/').split('/')[-2:])
+            return
+
+        m = RE_BUILD_TIME.match(line)
+        if m is not None:
+            self.elapsed = hms(*m.groups())
+
+    def close(self, now=None):
+        if self.__phase is not None:
+            now = self.__last if now is None else now
+            secs = self.phases.get(self.__phase, 0) + max(0, now - self.__since)
+            self.phases[self.__phase] = round(secs, 1)
+            self.__phase = None
+
+    def to_dict(self):
+        return {
+            'origin': self.origin,
+            'pkgname': self.pkgname,
+            'status': self.status,
+            'elapsed': self.elapsed,
+            'failed_phase': self.failed_phase,
+            'phases': self.phases
+        }
+
+
+class BuildLogWatcher:
+    def __init__(self, log_dir=None):
+        self.log_dir = log_dir
+        self.ports = {}
+        self.__logs = {}
+        self.__done = set()
+        self.__closed = set()
+        self.__status = []
+        self.attach(log_dir)
+
+    def attach(self, log_dir):
+        self.log_dir = log_dir
+        if log_dir is not None:
+            self.__status = [
+                (FileFollower(os.path.join(log_dir, '.poudriere.ports.built')),
+                 'built'),
+                (FileFollower(os.path.join(log_dir, '.poudriere.ports.failed')),
+                 'failed')
+            ]
+
+    def __port(self, pkgname):
+        if pkgname not in self.ports:
+            self.ports[pkgname] = PortTiming(pkgname)
+        return self.ports[pkgname]
+
+    def poll(self, now=None):
+        if self.log_dir is None:
+            return
+        now = time.monotonic() if now is None else now
+
+        # Lines are "origin pkgname elapsed" and "origin pkgname phase
+        # reason elapsed".
+        for follower, status in self.__status:
+            for line in follower.lines():
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                port = self.__port(fields[1])
+                port.origin = port.origin or fields[0]
+                port.status = status
+                if status == 'failed' and len(fields) >= 3:
+                    port.failed_phase = fields[2]
+                if fields[-1].isdigit() and len(fields) >= 3:
+                    port.elapsed = int(fields[-1])
+                self.__done.add(fields[1])
+
+        logs = os.path.join(self.log_dir, 'logs')
+        try:
+            names = [e.name for e in os.scandir(logs)
+                     if e.name.endswith('.log') and e.is_file()]
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            pkgname = name[:-4]
+            if pkgname not in self.__logs and pkgname not in self.__closed:
+                self.__logs[pkgname] = FileFollower(os.path.join(logs, name))
+
+        for pkgname, follower in list(self.__logs.items()):
+            port = self.__port(pkgname)
+            for line in follower.lines():
+                port.feed(line, now)
+            if pkgname in self.__done:
+                port.close()
+                del self.__logs[pkgname]
+                self.__closed.add(pkgname)
+
+    def finish(self):
+        self.poll()
+        for port in self.ports.values():
+            port.close()
+
+    def summary(self, top=10):
+        ports = [p.to_dict() for p in self.ports.values()]
+        phases = []
+        totals = {}
+        for p in ports:
+            for phase, secs in p['phases'].items():
+                phases.append({'origin': p['origin'], 'phase': phase,
+                               'seconds': secs})
+                totals[phase] = totals.get(phase, 0) + secs
+
+        def port_time(p):
+            return p['elapsed'] if p['elapsed'] is not None else \
+                sum(p['phases'].values())
+
+        return {
+            'log_dir': self.log_dir,
+            'ports': sorted(ports, key=lambda p: p['origin'] or p['pkgname']),
+            'phase_totals': totals,
+            'slowest_ports': [{'origin': p['origin'], 'seconds': port_time(p),
+                               'status': p['status']}
+                              for p in sorted(ports, key=port_time,
+                                              reverse=True)[:top]],
+            'slowest_phases': sorted(phases, key=lambda x: x['seconds'],
+                                     reverse=True)[:top]
+        }
@@ -0,0 +1,296 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import threading
+from tempfile import NamedTemporaryFile
+
+from .gitindex import git_tree_hashes
+
+logger = logging.getLogger('bandar.cache')
+
+VERSION = 2
+
+RE_INCLUDE = re.compile(r'^\s*\.\s*s?include\s+"([^"]+)"', re.M)
+RE_MASTERDIR = re.compile(r'^\s*MASTERDIR\s*[?:!]?=\s*(\S+)', re.M)
+RE_USES = re.compile(r'^\s*USES\s*\+?=\s*(.*)$', re.M)
+RE_PORT_DBDIR = re.compile(r'^\s*PORT_DBDIR\s*[?:]?=\s*(\S+)', re.M)
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'bandar')
+
+
+def atomic_write_json(path, obj):
+    # Readers only ever see the old file or the whole new one.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with NamedTemporaryFile('w', dir=os.path.dirname(path),
+                            prefix='.%s-' % os.path.basename(path),
+                            delete=False) as f:
+        try:
+            json.dump(obj, f)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def dir_keys(path):
+    try:
+        entries = sorted(os.listdir(path))
+    except OSError:
+        return []
+    out = []
+    for name in entries:
+        fn = os.path.join(path, name)
+        if os.path.isfile(fn):
+            out.append((name, stat_key(fn)))
+    return out
+
+
+def digest(obj):
+    return hashlib.sha1(repr(obj).encode()).hexdigest()
+
+
+def make_conf():
+    return os.environ.get('__MAKE_CONF', '/etc/make.conf')
+
+
+def port_dbdir():
+    if os.environ.get('PORT_DBDIR'):
+        return os.environ['PORT_DBDIR']
+    try:
+        with open(make_conf()) as f:
+            m = RE_PORT_DBDIR.search(f.read())
+    except OSError:
+        m = None
+    if m is not None and '$' not in m.group(1):
+        return m.group(1)
+    return '/var/db/ports'
+
+
+def options_file(origin):
+    # Where `make config` saves a port's OPTIONS
+    return os.path.join(port_dbdir(), origin.replace('/', '_'), 'options')
+
+
+def framework_key(layers):
+    # Mk/ in every layer, and make.conf with its DEFAULT_VERSIONS and
+    # other global knobs
+    keys = [dir_keys(os.path.join(layer, 'Mk')) for layer in layers]
+    keys.append((make_conf(), stat_key(make_conf())))
+    return digest(keys)
+
+
+def content_hash(path):
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d != 'work')
+        for name in sorted(filenames):
+            fn = os.path.join(dirpath, name)
+            h.update(os.path.relpath(fn, path).encode() + b'\x00')
+            try:
+                with open(fn, 'rb') as f:
+                    h.update(hashlib.sha1(f.read()).digest())
+            except OSError:
+                continue
+    return h.hexdigest()
+
+
+def layer_hashes(layer, paths):
+    # Clean paths in a git checkout are keyed on their tree object id; the
+    # rest fall back to hashing the working tree.
+    out = git_tree_hashes(layer, paths)
+    for p in paths:
+        if p not in out:
+            out[p] = content_hash(os.path.join(layer, p))
+    return out
+
+
+class DependencyCache:
+    def __init__(self, layers, path=None):
+        self.layers = [os.path.abspath(layer) for layer in layers]
+        self.path = path or os.path.join(cache_dir(),
+            'deps-%s.json' % digest(self.layers)[:16])
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        self.__framework = framework_key(self.layers)
+        self.__entries = self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if data.get('version') != VERSION:
+            return {}
+
+        # A change to the core framework invalidates every entry.
+        if data.get('framework') != self.__framework:
+            logger.debug('framework changed, discarding %s' % self.path)
+            return {}
+        return data.get('ports', {})
+
+    def __read_makefiles(self, origin):
+        for layer in self.layers:
+            fn = os.path.join(layer, origin, 'Makefile')
+            try:
+                with open(fn) as f:
+                    return f.read()
+            except OSError:
+                continue
+        return ''
+
+    def __expand(self, path, origin, masterdir):
+        path = path.replace('${.CURDIR}', origin) \
+                   .replace('${PORTSDIR}', '') \
+                   .replace('${MASTERDIR}', masterdir or origin)
+        if '$' in path:
+            return None
+        return os.path.normpath(path.lstrip('/'))
+
+    # Fingerprint every input that can change the dependencies of a port,
+    # or None if an include can't be resolved without running make.
+    def port_key(self, origin):
+        origin = origin.split('@', 1)[0]
+        keys = [dir_keys(os.path.join(layer, origin)) for layer in self.layers]
+        keys.append(stat_key(options_file(origin)))
+        makefile = self.__read_makefiles(origin)
+
+        masterdir = None
+        m = RE_MASTERDIR.search(makefile)
+        if m is not None:
+            masterdir = self.__expand(m.group(1), origin, None)
+            if masterdir is None:
+                return None
+            keys += [dir_keys(os.path.join(layer, masterdir))
+                     for layer in self.layers]
+
+        for include in RE_INCLUDE.findall(makefile):
+            fn = self.__expand(include, origin, masterdir)
+            if fn is None:
+                return None
+            keys += [(fn, stat_key(os.path.join(layer, fn)))
+                     for layer in self.layers]
+
+        for line in RE_USES.findall(makefile):
+            for uses in line.split():
+                fn = os.path.join('Mk', 'Uses', '%s.mk' % uses.split(':')[0])
+                keys += [(fn, stat_key(os.path.join(layer, fn)))
+                         for layer in self.layers]
+
+        return digest(keys)
+
+    def get(self, origin):
+        key = self.port_key(origin)
+        with self.__lock:
+            entry = self.__entries.get(origin)
+            if key is not None and entry is not None and entry['key'] == key:
+                self.hits += 1
+                return entry['value']
+            self.misses += 1
+        return None
+
+    def put(self, origin, value):
+        key = self.port_key(origin)
+        if key is None:
+            return
+        with self.__lock:
+            self.__entries[origin] = {'key': key, 'value': value}
+            self.__dirty = True
+
+    def save(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            data = {'version': VERSION, 'framework': self.__framework,
+                    'ports': self.__entries}
+            self.__dirty = False
+
+        atomic_write_json(self.path, data)
+        logger.debug('saved %d entries to %s' % (len(data['ports']), self.path))
+
+
+class LintCache:
+    def __init__(self, layers, version, path=None):
+        self.layers = [os.path.abspath(layer) for layer in layers]
+        self.version = version
+        self.path = path or os.path.join(cache_dir(), 'lint')
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__framework = digest([layer_hashes(layer, ['Mk'])['Mk']
+                                   for layer in self.layers])
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def keys(self, ports, args=()):
+        hashes = [layer_hashes(layer, ports) for layer in self.layers]
+        return dict((port, digest([port] + [h[port] for h in hashes] +
+                    [self.__framework, self.version, list(args)]))
+                    for port in ports)
+
+    def __fn(self, key):
+        return os.path.join(self.path, key[:2], '%s.json' % key)
+
+    def get(self, key):
+        try:
+            with open(self.__fn(key)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+
+        with self.__lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, value):
+        atomic_write_json(self.__fn(key), value)
@@ -0,0 +1,267 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# A persistent distfile store shared by every overlay, test worker and
+# poudriere run. Files are kept by their distinfo SHA256 and are checked
+# once, when they first come in; after that a run's DISTDIR is a
+# directory of hard links into the store, and NO_CHECKSUM is set when it
+# already holds every distfile the port needs.
+#
+# Runs only ever add files by renaming them into place, under a shared
+# lock; eviction takes the lock exclusively.
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .cache import cache_dir
+from .reaper import pid_alive
+
+RE_DISTINFO = re.compile(r'^(SHA256|SIZE) \((.+)\) = (\S+)$')
+RE_RUN = re.compile(r'^run-(\d+)-')
+
+CHUNK = 1 << 20
+
+
+def read_distinfo(port_dir):
+    # {name: (sha256, size)} for every distfile listed in the distinfo
+    values = {}
+    try:
+        with open(os.path.join(port_dir, 'distinfo')) as f:
+            for line in f:
+                m = RE_DISTINFO.match(line.strip())
+                if m is not None:
+                    values.setdefault(m.group(2), {})[m.group(1)] = m.group(3)
+    except OSError:
+        return {}
+
+    out = {}
+    for name, v in values.items():
+        if 'SHA256' in v and '..' not in name.split('/'):
+            out[name] = (v['SHA256'].lower(), int(v.get('SIZE', -1)))
+    return out
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def place(src, dst):
+    # Hard link where possible, copy across filesystems; either way dst
+    # only appears once it is complete.
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.bandar-', dir=os.path.dirname(dst))
+    tmp = os.path.join(tmp_dir, os.path.basename(dst))
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def parse_size(value):
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_age(value):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) * 86400
+
+
+class DistfileCache:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'distfiles')
+        self.store = os.path.join(self.path, 'sha256')
+        self.runs = os.path.join(self.path, 'runs')
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.__lock = threading.Lock()
+
+    def object_path(self, sha):
+        return os.path.join(self.store, sha[:2], sha)
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def seed(self, distdir, distinfo):
+        # Puts every stored distfile of a port into distdir; returns the
+        # names that still have to be fetched.
+        missing = []
+        hits = saved = 0
+        with self.lock():
+            for name, (sha, size) in sorted(distinfo.items()):
+                obj = self.object_path(sha)
+                dst = os.path.join(distdir, name)
+                try:
+                    st = os.stat(obj)
+                except FileNotFoundError:
+                    missing.append(name)
+                    continue
+                # A file already there is only possible in a DISTDIR shared
+                # with a tool that checks its own distfiles, which would not
+                # have fetched it either.
+                if os.path.exists(dst):
+                    continue
+                try:
+                    place(obj, dst)
+                except OSError:
+                    missing.append(name)
+                    continue
+                os.utime(obj)
+                hits += 1
+                saved += st.st_size
+
+        with self.__lock:
+            self.hits += hits
+            self.misses += len(missing)
+            self.bytes_saved += saved
+        return missing
+
+    def ingest(self, distdir, distinfo, names=None):
+        # Verifies what a run fetched and moves it into the store.
+        added = []
+        with self.lock():
+            for name in (names if names is not None else sorted(distinfo)):
+                sha, size = distinfo[name]
+                src = os.path.join(distdir, name)
+                if os.path.exists(self.object_path(sha)):
+                    continue
+                try:
+                    if size >= 0 and os.path.getsize(src) != size:
+                        continue
+                    if sha256_file(src) != sha:
+                        continue
+                    place(src, self.object_path(sha))
+                except OSError:
+                    continue
+                added.append(name)
+        return added
+
+    @contextmanager
+    def checkout(self, port_dir):
+        # Yields the environment for a run in port_dir: a private DISTDIR
+        # seeded from the store, whose new files are kept afterwards.
+        distinfo = read_distinfo(port_dir)
+        os.makedirs(self.runs, exist_ok=True)
+        distdir = tempfile.mkdtemp(prefix='run-%d-' % os.getpid(),
+                                   dir=self.runs)
+        try:
+            missing = self.seed(distdir, distinfo)
+            env = {'DISTDIR': distdir}
+            if len(distinfo) > 0 and len(missing) == 0:
+                env['NO_CHECKSUM'] = 'yes'
+            yield env
+            if len(missing) > 0:
+                self.ingest(distdir, distinfo, missing)
+        finally:
+            shutil.rmtree(distdir, ignore_errors=True)
+
+    @contextmanager
+    def shared(self, distdir, port_dirs):
+        # For a DISTDIR bandar doesn't own, such as poudriere's
+        # DISTFILES_CACHE: seeded before the run, harvested after it.
+        infos = [read_distinfo(d) for d in port_dirs]
+        missing = [self.seed(distdir, info) for info in infos]
+        yield
+        for info, names in zip(infos, missing):
+            self.ingest(distdir, info, names)
+
+    def entries(self):
+        out = []
+        for dirpath, dirnames, filenames in os.walk(self.store):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                fn = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, fn))
+        return out
+
+    def status(self):
+        entries = self.entries()
+        return {'path': self.path, 'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+    def evict(self, max_size=None, max_age=None, now=None):
+        # Drops files unused for longer than max_age seconds, then the
+        # least recently used until the store is at most max_size bytes.
+        now = now or time.time()
+        removed = []
+        with self.lock(exclusive=True):
+            self.sweep()
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, fn in entries:
+                too_old = max_age is not None and now - mtime > max_age
+                too_big = max_size is not None and total > max_size
+                if not too_old and not too_big:
+                    continue
+                os.unlink(fn)
+                total -= size
+                removed.append((fn, size))
+        return removed
+
+    def sweep(self):
+        # Run directories left behind by crashed processes
+        try:
+            names = os.listdir(self.runs)
+        except OSError:
+            return
+        for name in names:
+            m = RE_RUN.match(name)
+            if m is not None and not pid_alive(int(m.group(1))):
+                shutil.rmtree(os.path.join(self.runs, name), ignore_errors=True)
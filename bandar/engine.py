@@ -0,0 +1,205 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# An asyncio engine that owns every process it starts. All of them share
+# one concurrency limit, each may stream its output a line at a time, and
+# a timeout or cancellation terminates the process before the error is
+# passed on. `run` drives a coroutine to completion with SIGINT cancelling
+# it, so ^C stops every process in flight rather than just the one the
+# main thread happened to be blocked on.
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path
+import signal
+import subprocess
+
+from . import runner
+
+ProcessResult = namedtuple('ProcessResult', ['returncode', 'stdout'])
+
+# Longest line a streamed process may write; `make -V` of a big port's
+# dependency list easily exceeds asyncio's 64KiB default.
+LINE_LIMIT = 1 << 20
+
+
+class Engine:
+    def __init__(self, jobs=None):
+        self.jobs = max(1, jobs or os.cpu_count() or 1)
+        self.__limit = None
+        self.__waiters = None
+
+    def limit(self):
+        # Created on first use so that it belongs to the running loop.
+        if self.__limit is None:
+            self.__limit = asyncio.Semaphore(self.jobs)
+        return self.__limit
+
+    def waiters(self):
+        # A thread blocked in wait() for each running process, so that the
+        # profiling Popen reaps it with os.wait4 and records its CPU time.
+        if self.__waiters is None:
+            self.__waiters = ThreadPoolExecutor(max_workers=self.jobs,
+                thread_name_prefix='bandar-wait')
+        return self.__waiters
+
+    def close(self):
+        if self.__waiters is not None:
+            self.__waiters.shutdown(wait=False)
+            self.__waiters = None
+
+    def __signal(self, proc, sig):
+        # Each process leads its own group, so this reaches its children.
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def __stop(self, proc, wait):
+        if proc.returncode is not None:
+            return
+        self.__signal(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(wait(), 5)
+        except asyncio.TimeoutError:
+            self.__signal(proc, signal.SIGKILL)
+            await wait()
+        except asyncio.CancelledError:
+            self.__signal(proc, signal.SIGKILL)
+            raise
+
+    async def run(self, cmd, cwd=None, env=None, on_line=None, timeout=None,
+                  stdout=subprocess.PIPE, stderr=None):
+        # Output is returned whole unless `on_line` is given, in which case
+        # it is handed each decoded line as soon as it is written.
+        loop = asyncio.get_running_loop()
+        async with self.limit():
+            proc = runner.Popen(cmd, cwd=cwd, env=env,
+                stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr,
+                start_new_session=True)
+
+            waiter = None
+
+            def wait():
+                nonlocal waiter
+                if waiter is None:
+                    waiter = loop.run_in_executor(self.waiters(), proc.wait)
+                return asyncio.shield(waiter)
+
+            transport = None
+            out = []
+            nbytes = 0
+
+            async def communicate():
+                nonlocal transport, nbytes
+                if proc.stdout is not None:
+                    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+                    transport, _ = await loop.connect_read_pipe(
+                        lambda: asyncio.StreamReaderProtocol(reader),
+                        proc.stdout)
+                    while True:
+                        line = await reader.readline()
+                        if not line:
+                            break
+                        nbytes += len(line)
+                        if on_line is None:
+                            out.append(line)
+                        else:
+                            on_line(line.decode(errors='replace').rstrip('\n'))
+                    proc.set_output_bytes(nbytes)
+                return await wait()
+
+            try:
+                ret = await asyncio.wait_for(communicate(), timeout)
+            except asyncio.TimeoutError:
+                await self.__stop(proc, wait)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            except BaseException:
+                await self.__stop(proc, wait)
+                raise
+            finally:
+                if transport is not None:
+                    transport.close()
+                elif proc.stdout is not None:
+                    proc.stdout.close()
+
+        return ProcessResult(ret, b''.join(out) if on_line is None else None)
+
+    async def check_output(self, cmd, cwd=None, env=None, timeout=None):
+        res = await self.run(cmd, cwd, env, timeout=timeout)
+        if res.returncode != 0:
+            raise subprocess.CalledProcessError(res.returncode, cmd,
+                output=res.stdout)
+        return res.stdout
+
+    async def run_blocking(self, fn, *args):
+        # In-process work that spawns its own helpers, such as writing an
+        # archive, counts against the same limit.
+        async with self.limit():
+            return await asyncio.get_running_loop().run_in_executor(None, fn,
+                *args)
+
+
+async def drain():
+    # Lets whatever is still stopping its processes finish doing so, then
+    # cancels anything left outright.
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    if tasks:
+        await asyncio.wait(tasks, timeout=10)
+    tasks = [t for t in tasks if not t.done()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run(main):
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(main)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    try:
+        return loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        raise KeyboardInterrupt
+    finally:
+        loop.run_until_complete(drain())
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+def run_sync(fn, *args, jobs=None):
+    # Runs `fn(engine, *args)` to completion for a synchronous caller, with
+    # an engine and event loop of its own.
+    eng = Engine(jobs)
+    try:
+        return run(fn(eng, *args))
+    finally:
+        eng.close()
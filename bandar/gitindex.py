@@ -0,0 +1,252 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Reads the tracked files of a repository straight out of .git/index in
+# one pass over a memory map, instead of running `git ls-files` and then
+# stat()ing the results. Index versions 2 to 4 with SHA-1 object names are
+# understood; anything else falls back to `git ls-files -s`.
+
+from collections import namedtuple
+import mmap
+import os
+import os.path
+import struct
+import subprocess
+import threading
+
+from . import runner
+
+IndexEntry = namedtuple('IndexEntry', ['mode', 'sha', 'path'])
+
+HEADER = struct.Struct('>4sII')
+# ctime and mtime (seconds, nanoseconds), dev, ino, mode, uid, gid, size
+STAT = struct.Struct('>10I')
+STAT_MODE = 6
+SHA_LEN = 20
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE = 0x3000
+
+
+class UnsupportedIndex(ValueError):
+    pass
+
+
+def find_git_dir(path):
+    # Returns (worktree root, git dir) for the repository containing path.
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return path, dot_git
+        if os.path.isfile(dot_git):
+            with open(dot_git) as f:
+                line = f.read().strip()
+            if not line.startswith('gitdir:'):
+                raise UnsupportedIndex("Can't parse '%s'" % dot_git)
+            return path, os.path.join(path, line[7:].strip())
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise UnsupportedIndex("'%s' is not in a git repository" % path)
+        path = parent
+
+
+def git_tree_hashes(path, paths):
+    # Tree object ids of each of `paths` at HEAD, leaving out any that are
+    # untracked or have uncommitted changes.
+    try:
+        data = runner.check_output(['git', 'ls-tree', '-z', 'HEAD', '--'] +
+            list(paths), cwd=path, stderr=subprocess.DEVNULL)
+        # Without renames, every entry is a single path with a status.
+        status = runner.check_output(['git', 'status', '--porcelain', '-z',
+            '--no-renames', '--untracked-files=all', '--'] + list(paths),
+            cwd=path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+    out = {}
+    for entry in data.decode().split('\x00')[:-1]:
+        meta, fn = entry.split('\t', 1)
+        mode, kind, sha = meta.split()
+        if kind == 'tree':
+            out[fn] = sha
+
+    for entry in status.decode().split('\x00'):
+        fn = entry[3:]
+        for p in paths:
+            if fn == p or fn.startswith(p + '/'):
+                out.pop(p, None)
+    return out
+
+
+def read_varint(mm, pos):
+    c = mm[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = mm[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+
+def uses_sha1(git_dir):
+    dirs = [git_dir]
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            dirs.append(os.path.join(git_dir, f.read().strip()))
+    except OSError:
+        pass
+
+    for d in dirs:
+        try:
+            with open(os.path.join(d, 'config')) as f:
+                config = f.read().lower().replace(' ', '').replace('\t', '')
+        except OSError:
+            continue
+        if 'objectformat=sha256' in config:
+            return False
+    return True
+
+
+def parse_index(mm):
+    magic, version, count = HEADER.unpack_from(mm)
+    if magic != b'DIRC' or version not in (2, 3, 4):
+        raise UnsupportedIndex("Unsupported index version %r" % version)
+
+    out = []
+    pos = HEADER.size
+    prev = b''
+    for _ in range(count):
+        start = pos
+        mode = STAT.unpack_from(mm, pos)[STAT_MODE]
+        pos += STAT.size
+        sha = mm[pos:pos + SHA_LEN].hex()
+        pos += SHA_LEN
+        flags = struct.unpack_from('>H', mm, pos)[0]
+        pos += 2
+        if flags & FLAG_EXTENDED:
+            if version < 3:
+                raise UnsupportedIndex("Extended flags in a version 2 index")
+            pos += 2
+
+        if version == 4:
+            strip, pos = read_varint(mm, pos)
+            end = mm.find(b'\x00', pos)
+            name = prev[:len(prev) - strip] + mm[pos:end]
+            pos = end + 1
+        else:
+            end = mm.find(b'\x00', pos)
+            name = mm[pos:end]
+            # Entries are NUL-padded to a multiple of eight bytes.
+            pos = start + ((end - start) // 8 + 1) * 8
+        prev = name
+
+        if mode & 0o170000 == 0o040000:
+            raise UnsupportedIndex("Sparse index entries are not supported")
+        if flags & FLAG_STAGE:
+            continue
+        out.append(IndexEntry('%06o' % mode, sha, name.decode()))
+
+    # A split index keeps most entries in another file.
+    while pos + 8 <= len(mm) - SHA_LEN:
+        sig, size = struct.unpack_from('>4sI', mm, pos)
+        if sig == b'link':
+            raise UnsupportedIndex("Split indexes are not supported")
+        pos += 8 + size
+    return out
+
+
+def read_index(path):
+    root, git_dir = find_git_dir(path)
+    if not uses_sha1(git_dir):
+        raise UnsupportedIndex("Only SHA-1 repositories are supported")
+
+    with open(os.path.join(git_dir, 'index'), 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            entries = parse_index(mm)
+
+    prefix = os.path.relpath(os.path.abspath(path), root)
+    if prefix == '.':
+        return entries
+    prefix += '/'
+    return [e._replace(path=e.path[len(prefix):]) for e in entries
+            if e.path.startswith(prefix)]
+
+
+def ls_files_entries(path):
+    data = runner.check_output(['git', 'ls-files', '-s', '-z'], cwd=path)
+    out = []
+    for entry in data.decode().split('\x00')[:-1]:
+        meta, fn = entry.split('\t', 1)
+        mode, sha, stage = meta.split()
+        if stage == '0':
+            out.append(IndexEntry(mode, sha, fn))
+    return out
+
+
+class GitIndex:
+    __cache = {}
+    __lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        try:
+            self.entries = read_index(self.path)
+            self.native = True
+        except (OSError, UnsupportedIndex):
+            self.entries = ls_files_entries(self.path)
+            self.native = False
+
+        self.by_port = {}
+        for entry in self.entries:
+            chunks = entry.path.split('/', 2)
+            if len(chunks) < 3:
+                continue
+            self.by_port.setdefault("/".join(chunks[:2]), []).append(entry)
+
+    @classmethod
+    def load(cls, path):
+        # One scan per repository for as long as its index is unchanged
+        path = os.path.abspath(path)
+        try:
+            root, git_dir = find_git_dir(path)
+            st = os.stat(os.path.join(git_dir, 'index'))
+            key = (path, st.st_mtime_ns, st.st_size)
+        except (OSError, UnsupportedIndex):
+            key = None
+
+        with cls.__lock:
+            index = cls.__cache.get(path)
+            if key is None or index is None or index.key != key:
+                index = cls(path)
+                index.key = key
+                cls.__cache[path] = index
+        return index
+
+    def ports(self):
+        return sorted(p for p in self.by_port
+                      if os.path.isdir(os.path.join(self.path, p)))
+
+    def files(self, port):
+        return self.by_port.get(port, [])
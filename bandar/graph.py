@@ -0,0 +1,141 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+from array import array
+
+WHITE, GREY, BLACK = 0, 1, 2
+
+
+def dot_quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def dependents(deps, ports):
+    # The ports in `deps` (port -> children) that depend on any of `ports`,
+    # directly or transitively. Flavors are dropped, so reaching a port
+    # through `devel/lib@py39` counts as depending on `devel/lib`.
+    rdeps = {}
+    for port, children in deps.items():
+        for child in children:
+            rdeps.setdefault(child.split('@', 1)[0], set()).add(
+                port.split('@', 1)[0])
+
+    seen = set(ports)
+    order = list(ports)
+    for port in order:
+        for parent in rdeps.get(port, ()):
+            if parent not in seen:
+                seen.add(parent)
+                order.append(parent)
+    return seen - set(ports)
+
+
+class DependencyGraph:
+    # Ports are interned to integer ids; each node's edges are an array of
+    # child ids, so shared subtrees are stored exactly once.
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.edges = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def intern(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+            self.edges.append(array('I'))
+        return i
+
+    def add(self, name, children):
+        i = self.intern(name)
+        self.edges[i] = array('I', [self.intern(c) for c in children])
+        return i
+
+    def children(self, name):
+        return [self.names[c] for c in self.edges[self.index[name]]]
+
+    def reachable(self, root):
+        start = self.index[root]
+        seen = {start}
+        order = [start]
+        for node in order:
+            for child in self.edges[node]:
+                if child not in seen:
+                    seen.add(child)
+                    order.append(child)
+        return order
+
+    def find_cycles(self, root=None):
+        starts = range(len(self)) if root is None else [self.index[root]]
+        colour = bytearray(len(self))
+        cycles = []
+
+        for start in starts:
+            if colour[start] != WHITE:
+                continue
+            colour[start] = GREY
+            path = [start]
+            stack = [iter(self.edges[start])]
+
+            while stack:
+                child = next(stack[-1], None)
+                if child is None:
+                    colour[path.pop()] = BLACK
+                    stack.pop()
+                elif colour[child] == GREY:
+                    cycle = path[path.index(child):] + [child]
+                    cycles.append([self.names[n] for n in cycle])
+                elif colour[child] == WHITE:
+                    colour[child] = GREY
+                    path.append(child)
+                    stack.append(iter(self.edges[child]))
+
+        return cycles
+
+    def to_dict(self, root):
+        nodes = self.reachable(root)
+        return {
+            'root': root,
+            'nodes': [self.names[n] for n in nodes],
+            'edges': dict((self.names[n], [self.names[c] for c in self.edges[n]])
+                          for n in nodes),
+            'cycles': self.find_cycles(root)
+        }
+
+    def iter_dot(self, root):
+        yield 'digraph %s {' % dot_quote(root)
+        for node in self.reachable(root):
+            name = dot_quote(self.names[node])
+            edges = self.edges[node]
+            if len(edges) == 0:
+                yield '  %s;' % name
+            for child in edges:
+                yield '  %s -> %s;' % (name, dot_quote(self.names[child]))
+        yield '}'
@@ -0,0 +1,367 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Reads the dependencies of simple ports straight from their Makefiles,
+# skipping make and its parse of the whole Mk/ framework. Only plain
+# assignments are understood; a port with conditionals, includes other
+# than bsd.port.mk, OPTIONS, flavors, or variables this can't resolve is
+# Unsupported and left to make.
+#
+# What each USES entry adds is learned from make once, by probing an
+# otherwise empty port, and cached until the framework changes.
+
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+
+from . import runner
+from .cache import (atomic_write_json, cache_dir, digest, framework_key,
+    stat_key)
+
+logger = logging.getLogger('bandar.makefile')
+
+VERSION = 2
+
+KINDS = ['BUILD_DEPENDS', 'LIB_DEPENDS', 'RUN_DEPENDS', 'TEST_DEPENDS']
+
+RE_ASSIGN = re.compile(r'^([A-Za-z0-9_.${}]+)\s*([+?:!]?=)\s*(.*)$')
+RE_VAR = re.compile(r'\$(?:\{([^}]*)\}|\((.*?)\)|(.))')
+
+INCLUDES_OK = ['.include <bsd.port.mk>']
+
+# USE_* knobs that never add dependencies; any other is left to make.
+SAFE_USE = {'USE_GITHUB', 'USE_GITLAB', 'USE_LDCONFIG', 'USE_LOCALE',
+            'USE_RC_SUBR', 'USE_CSTD', 'USE_CXXSTD', 'USE_SUBMAKE'}
+
+UNSAFE_VARS = {'MASTERDIR', 'SLAVE_PORT', 'FLAVOR', 'FLAVORS',
+               'OPTIONS_DEFINE', 'OPTIONS_DEFAULT', 'OPTIONS_GROUP',
+               'OPTIONS_MULTI', 'OPTIONS_RADIO', 'OPTIONS_SINGLE',
+               'OPTIONS_SLAVE', 'OPTIONS_EXCLUDE'}
+
+PROBE_MAKEFILE = '''\
+PORTNAME=	bandar-probe
+DISTVERSION=	1
+CATEGORIES=	misc
+MAINTAINER=	ports@FreeBSD.org
+COMMENT=	Dependency probe
+%s
+.include <bsd.port.mk>
+'''
+
+
+class Unsupported(ValueError):
+    pass
+
+
+def logical_lines(text):
+    line = ''
+    for raw in text.split('\n'):
+        if raw.endswith('\\'):
+            line += raw[:-1] + ' '
+            continue
+        yield line + raw
+        line = ''
+    if line:
+        yield line
+
+
+def parse_makefile(text):
+    # (operator, name, value) for every assignment, in order.
+    out = []
+    for line in logical_lines(text):
+        stripped = line.strip()
+        if stripped == '' or stripped.startswith('#'):
+            continue
+        if stripped.startswith('.'):
+            if ' '.join(stripped.split()) in INCLUDES_OK:
+                continue
+            raise Unsupported("directive '%s'" % stripped)
+        if line.startswith('\t'):
+            # A target's recipe
+            continue
+
+        m = RE_ASSIGN.match(stripped)
+        if m is None:
+            if ':' in stripped:
+                # A target, which can't change what make -V reports
+                continue
+            raise Unsupported("line '%s'" % stripped)
+        name, op, value = m.groups()
+        if '$' in name:
+            raise Unsupported("computed variable name '%s'" % name)
+        if op == '!=':
+            raise Unsupported("shell assignment to %s" % name)
+        out.append((op, name, value.split('#', 1)[0].strip()))
+    return out
+
+
+def assign(assignments):
+    values = {}
+    for op, name, value in assignments:
+        if op == '+=':
+            values[name] = (values.get(name, '') + ' ' + value).strip()
+        elif op == '?=':
+            values.setdefault(name, value)
+        else:
+            values[name] = value
+    return values
+
+
+def check_safe(values):
+    for name, value in values.items():
+        if name in UNSAFE_VARS and value != '':
+            raise Unsupported("%s is set" % name)
+        if name.startswith('OPTIONS_') or '_DEPENDS_' in name:
+            raise Unsupported("%s is set" % name)
+        if name.startswith('USE_') and name not in SAFE_USE:
+            raise Unsupported("%s is set" % name)
+        if name.endswith('_DEPENDS') and name not in KINDS and \
+                name not in ('FETCH_DEPENDS', 'EXTRACT_DEPENDS',
+                             'PATCH_DEPENDS', 'PKG_DEPENDS'):
+            raise Unsupported("%s is set" % name)
+
+
+def expand(value, values, builtins, seen=()):
+    def sub(m):
+        name = m.group(1) or m.group(2) or m.group(3)
+        if name == '$':
+            return '$'
+        if ':' in name or '$' in name:
+            raise Unsupported("modifier in '%s'" % m.group(0))
+        if name in seen:
+            raise Unsupported("recursive variable %s" % name)
+        if name in values:
+            return expand(values[name], values, builtins, seen + (name,))
+        if name in builtins:
+            return expand(builtins[name], values, builtins, seen + (name,))
+        raise Unsupported("unknown variable %s" % name)
+    return RE_VAR.sub(sub, value)
+
+
+def port_version(distversion):
+    # bsd.port.mk's conversion of DISTVERSION into PORTVERSION
+    v = distversion.lower()
+    v = re.sub(r'([a-z])[a-z]+', r'\1', v)
+    v = re.sub(r'([0-9])([a-z])', r'\1.\2', v)
+    v = re.sub(r':(.)', r'\1', v)
+    return re.sub(r'[^a-z0-9+]+', '.', v)
+
+
+def package_name(values, get):
+    if 'PKGNAME' in values:
+        return get('PKGNAME')
+    if 'PORTNAME' not in values:
+        raise Unsupported("no PORTNAME")
+
+    if 'PORTVERSION' in values:
+        version = get('PORTVERSION')
+    elif 'DISTVERSION' in values:
+        version = port_version(get('DISTVERSION'))
+    else:
+        raise Unsupported("no PORTVERSION or DISTVERSION")
+
+    revision = get('PORTREVISION') if 'PORTREVISION' in values else '0'
+    epoch = get('PORTEPOCH') if 'PORTEPOCH' in values else '0'
+    if revision not in ('', '0'):
+        version += '_' + revision
+    if epoch not in ('', '0'):
+        version += ',' + epoch
+
+    prefix = get('PKGNAMEPREFIX') if 'PKGNAMEPREFIX' in values else ''
+    suffix = get('PKGNAMESUFFIX') if 'PKGNAMESUFFIX' in values else ''
+    return '%s%s%s-%s' % (prefix, get('PORTNAME'), suffix, version)
+
+
+class UsesTable:
+    # Maps each USES entry to the dependencies it adds, learnt from make.
+    def __init__(self, mountpoint, layers, path=None):
+        self.mnt = mountpoint
+        self.layers = [os.path.abspath(layer) for layer in layers]
+        self.path = path or os.path.join(cache_dir(),
+            'uses-%s.json' % digest(self.layers)[:16])
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        self.__framework = framework_key(self.layers)
+        self.__entries = self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != VERSION or \
+                data.get('framework') != self.__framework:
+            return {}
+        return data.get('uses', {})
+
+    def __key(self, uses):
+        fn = os.path.join('Mk', 'Uses', '%s.mk' % uses.split(':')[0])
+        return digest([stat_key(os.path.join(layer, fn))
+                       for layer in self.layers])
+
+    def __probe(self, uses_line):
+        root = tempfile.mkdtemp(prefix='bandar-probe-')
+        try:
+            port = os.path.join(root, 'misc', 'bandar-probe')
+            os.makedirs(port)
+            with open(os.path.join(port, 'Makefile'), 'w') as f:
+                f.write(PROBE_MAKEFILE % uses_line)
+
+            cmd = ['make']
+            for var in KINDS + ['FLAVORS']:
+                cmd += ['-V', var]
+            data = runner.check_output(cmd, cwd=port,
+                env=dict(os.environ, PORTSDIR=self.mnt))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        # Overlays are mounted somewhere new on every run.
+        data = data.decode().replace(self.mnt, '${PORTSDIR}')
+        return dict(zip(KINDS + ['FLAVORS'], data.split('\n')))
+
+    def __baseline(self):
+        # What the framework adds to every port, such as devel/ccache with
+        # WITH_CCACHE_BUILD
+        if '' not in self.__entries:
+            try:
+                value = self.__probe('')
+            except runner.subprocess.CalledProcessError:
+                raise Unsupported("make can't evaluate an empty port")
+            self.__entries[''] = {'key': None, 'value': value}
+            self.__dirty = True
+        return self.__entries['']['value']
+
+    def baseline(self):
+        with self.__lock:
+            return self.__baseline()
+
+    def get(self, uses):
+        key = self.__key(uses)
+        with self.__lock:
+            entry = self.__entries.get(uses)
+            if entry is not None and entry['key'] == key:
+                return entry['value']
+
+            base = self.__baseline()
+            try:
+                probe = self.__probe('USES=\t%s' % uses)
+            except runner.subprocess.CalledProcessError:
+                raise Unsupported("make can't evaluate USES=%s" % uses)
+
+            value = {'flavors': probe['FLAVORS'].strip()}
+            for kind in KINDS:
+                own = base[kind].split()
+                value[kind] = [d for d in probe[kind].split() if d not in own]
+            self.__entries[uses] = {'key': key, 'value': value}
+            self.__dirty = True
+            logger.debug('USES=%s adds %r' % (uses, value))
+            return value
+
+    def save(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            data = {'version': VERSION, 'framework': self.__framework,
+                    'uses': self.__entries}
+            self.__dirty = False
+
+        atomic_write_json(self.path, data)
+
+
+class MakefileEvaluator:
+    def __init__(self, mountpoint, uses_table):
+        self.mnt = mountpoint
+        self.uses = uses_table
+        self.builtins = {
+            'PORTSDIR': mountpoint,
+            'LOCALBASE': '/usr/local',
+            'PREFIX': '/usr/local',
+            'FILESDIR': '${.CURDIR}/files',
+        }
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def lines(self, origin):
+        # The values `make -V` would print for PortQuery's VARS.
+        if '@' in origin:
+            raise Unsupported("flavored origin")
+
+        try:
+            with open(os.path.join(self.mnt, origin, 'Makefile')) as f:
+                text = f.read()
+        except OSError:
+            raise Unsupported("no Makefile")
+
+        values = assign(parse_makefile(text))
+        check_safe(values)
+        builtins = dict(self.builtins, **{
+            '.CURDIR': os.path.join(self.mnt, origin),
+            'PREFIX': values.get('PREFIX', self.builtins['PREFIX'])})
+        get = lambda name: expand(values.get(name, ''), values, builtins)
+
+        def learnt(deps):
+            return [d.replace('${PORTSDIR}', self.mnt) for d in deps]
+
+        deps = dict((kind, get(kind).split()) for kind in KINDS)
+        for uses in get('USES').split():
+            added = self.uses.get(uses)
+            if added['flavors'] != '':
+                raise Unsupported("USES=%s has flavors" % uses)
+            for kind in KINDS:
+                deps[kind] += [d for d in learnt(added[kind])
+                               if d not in deps[kind]]
+
+        base = self.uses.baseline()
+        for kind in KINDS:
+            deps[kind] += [d for d in learnt(base[kind].split())
+                           if d not in deps[kind]]
+
+        return [package_name(values, get), ''] + \
+            [' '.join(deps[kind]) for kind in KINDS]
+
+    def evaluate(self, origin):
+        try:
+            out = self.lines(origin)
+        except Unsupported as e:
+            logger.debug('%s: falling back to make: %s' % (origin, e))
+            with self.__lock:
+                self.misses += 1
+            raise
+        with self.__lock:
+            self.hits += 1
+        return out
+
+    def save(self):
+        self.uses.save()
@@ -0,0 +1,426 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import atexit
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from . import reaper, runner
+from .cache import atomic_write_json, cache_dir, digest
+
+logger = logging.getLogger('bandar.overlay')
+
+
+def check_path(path, rel=None):
+    if rel is not None:
+        path = os.path.join(rel, path)
+    abspath = os.path.abspath(path)
+    if os.path.isdir(abspath):
+        return abspath
+    raise ValueError("The path '%s' does not exist!" % abspath)
+
+
+def mount_unionfs(layers, workspace, mountpoint, max_files=65536):
+    ufs_layers = ":".join("%s=RO" % check_path(layer) for layer in layers)
+    cmd = ['unionfs', '-o', 'cow,max_files=%s' % max_files,
+            "%s=RW:%s" % (workspace, ufs_layers),
+            mountpoint]
+    logger.debug(cmd)
+
+    runner.check_output(cmd)
+
+
+class UnionfsBackend:
+    name = 'unionfs'
+    jail_safe = True
+
+    def available(self):
+        return shutil.which('unionfs') is not None
+
+    def mount(self, layers, workspace, mountpoint, max_files=65536):
+        mount_unionfs(layers, workspace, mountpoint, max_files)
+
+    def is_mounted(self, mountpoint):
+        return os.path.ismount(mountpoint)
+
+    def refresh(self, layers, workspace, mountpoint):
+        pass
+
+    def unmount(self, mountpoint):
+        runner.call(['umount', '-f', mountpoint])
+
+
+class OverlayfsBackend(UnionfsBackend):
+    name = 'overlayfs'
+
+    def available(self):
+        try:
+            with open('/proc/filesystems') as f:
+                return any(line.split()[-1] == 'overlay' for line in f)
+        except OSError:
+            return False
+
+    def mount(self, layers, workspace, mountpoint, max_files=None):
+        upper = os.path.join(workspace, 'upper')
+        work = os.path.join(workspace, 'work')
+        os.makedirs(upper, exist_ok=True)
+        os.makedirs(work, exist_ok=True)
+
+        lower = ":".join(check_path(layer) for layer in layers)
+        cmd = ['mount', '-t', 'overlay', 'overlay', '-o',
+            'lowerdir=%s,upperdir=%s,workdir=%s' % (lower, upper, work),
+            mountpoint]
+        logger.debug(cmd)
+
+        runner.check_output(cmd)
+
+
+class FarmBackend:
+    # A merged tree of symlinks built in userspace, so nothing pays for a
+    # FUSE round trip. Category and port directories are always real so
+    # that `work/` and other new files land in the farm, and so .CURDIR
+    # stays inside it; everything below a port is linked to the highest
+    # layer providing it. Files that already exist are *not* copied on
+    # write: editing them through the farm edits the layer itself.
+    name = 'farm'
+    jail_safe = False
+    real_depth = 2
+
+    def available(self):
+        return True
+
+    def mount(self, layers, workspace, mountpoint, max_files=None):
+        self.refresh(layers, workspace, mountpoint)
+
+    def is_mounted(self, mountpoint):
+        return os.path.isfile(os.path.join(mountpoint, reaper.FARM_MARKER))
+
+    def unmount(self, mountpoint):
+        for name in os.listdir(mountpoint):
+            remove_entry(os.path.join(mountpoint, name))
+
+    def refresh(self, layers, workspace, mountpoint):
+        layers = [check_path(layer) for layer in layers]
+        manifest_fn = os.path.join(mountpoint, reaper.FARM_MARKER)
+        try:
+            with open(manifest_fn) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        old = manifest.get('dirs', {}) if manifest.get('layers') == layers else {}
+        new = {}
+        stack = [('', layers)]
+        while stack:
+            rel, srcs = stack.pop()
+            children = self.__sync(mountpoint, rel, srcs, old.get(rel))
+            new[rel] = children
+            stack.extend((os.path.join(rel, name), sub)
+                         for name, sub in children['dirs'].items())
+
+        atomic_write_json(manifest_fn, {'layers': layers, 'dirs': new})
+
+    def __sync(self, farm, rel, srcs, prev):
+        # Only directories whose sources changed (as seen by their mtimes)
+        # are listed again; the rest are taken from the manifest.
+        key = [mtime_ns(src) for src in srcs]
+        if prev is not None and prev['key'] == key:
+            return prev
+
+        dst = os.path.join(farm, rel)
+        depth = 0 if rel == '' else rel.count('/') + 1
+        entries = merge_entries(srcs, skip_hidden=(rel == ''))
+        dirs = {}
+
+        for name, paths in entries.items():
+            fn = os.path.join(dst, name)
+            if isinstance(paths, list) and (depth < self.real_depth or
+                                            len(paths) > 1):
+                dirs[name] = paths
+                if os.path.islink(fn) or os.path.isfile(fn):
+                    os.unlink(fn)
+                if not os.path.isdir(fn):
+                    os.mkdir(fn)
+                continue
+
+            target = paths[0] if isinstance(paths, list) else paths
+            if os.path.islink(fn):
+                if os.readlink(fn) == target:
+                    continue
+                os.unlink(fn)
+            elif os.path.lexists(fn):
+                remove_entry(fn)
+            os.symlink(target, fn)
+
+        # Drop what has gone from the layers, but leave anything the build
+        # created itself (work/, distfiles) alone.
+        known = set(prev['dirs']) if prev is not None else set()
+        for name in os.listdir(dst):
+            if name in entries or name == reaper.FARM_MARKER:
+                continue
+            fn = os.path.join(dst, name)
+            if os.path.islink(fn) or name in known:
+                remove_entry(fn)
+
+        return {'key': key, 'dirs': dirs}
+
+
+BACKENDS = {
+    'unionfs': UnionfsBackend,
+    'overlayfs': OverlayfsBackend,
+    'farm': FarmBackend
+}
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown overlay backend '%s'!" % name)
+    backend = BACKENDS[name]()
+    if not backend.available():
+        raise ValueError("The overlay backend '%s' is not available here!" %
+            name)
+    return backend
+
+
+def mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def remove_entry(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path)
+
+
+def merge_entries(srcs, skip_hidden=False):
+    # Maps each name to the file that wins, or to the list of directories
+    # that are merged under it, highest layer first.
+    found = {}
+    for src in srcs:
+        try:
+            names = os.listdir(src)
+        except OSError:
+            continue
+        for name in names:
+            if skip_hidden and name.startswith('.'):
+                continue
+            found.setdefault(name, []).append(os.path.join(src, name))
+
+    out = {}
+    for name, paths in found.items():
+        if not os.path.isdir(paths[0]):
+            out[name] = paths[0]
+            continue
+        dirs = []
+        for path in paths:
+            if not os.path.isdir(path):
+                break
+            dirs.append(path)
+        out[name] = dirs
+    return out
+
+
+class Overlay:
+    persistent = False
+
+    def __init__(self, layers, workspace=None, mountpoint=None, max_files=65536,
+                 backend='unionfs'):
+        self.backend = get_backend(backend)
+        self.layers = layers
+
+        # Stamp our pid into the directory names so the reaper can tell
+        # leftovers of crashed runs from overlays that are still in use.
+        prefix = 'bandar-%%s-%d-' % os.getpid()
+        self.__owned = workspace is None and mountpoint is None
+        self.workspace = workspace.name if workspace is not None \
+            else tempfile.mkdtemp(prefix=prefix % 'work')
+        self.mountpoint = mountpoint.name if mountpoint is not None \
+            else tempfile.mkdtemp(prefix=prefix % 'mnt')
+
+        with runner.span('overlay.mount', backend=self.backend.name):
+            self.backend.mount(layers, self.workspace, self.mountpoint,
+                max_files)
+
+        self.__unmounted = False
+        atexit.register(self.__unmount)
+
+    def __del__(self):
+        if self.__unmounted is False:
+            self.__unmount()
+
+    def __unmount(self):
+        atexit.unregister(self.__unmount)
+        self.__unmounted = True
+
+        with runner.span('overlay.unmount', backend=self.backend.name):
+            if self.__owned:
+                reaper.spawn(self.mountpoint, self.workspace)
+            else:
+                self.backend.unmount(self.mountpoint)
+
+    def refresh(self):
+        with runner.span('overlay.refresh', backend=self.backend.name):
+            self.backend.refresh(self.layers, self.workspace, self.mountpoint)
+
+    def close(self):
+        if self.__unmounted is False:
+            self.__unmount()
+
+
+class SessionOverlay:
+    # An overlay owned by an OverlaySession; it outlives this process, so
+    # closing it does nothing.
+    persistent = True
+
+    def __init__(self, state):
+        self.state = state
+        self.backend = get_backend(state.get('backend', 'unionfs'))
+        self.layers = state['layers']
+        self.workspace = state['workspace']
+        self.mountpoint = state['mountpoint']
+
+    def refresh(self):
+        with runner.span('overlay.refresh', backend=self.backend.name):
+            self.backend.refresh(self.layers, self.workspace, self.mountpoint)
+
+    def close(self):
+        pass
+
+
+class OverlaySession:
+    def __init__(self, layers):
+        self.layers = [check_path(layer) for layer in layers]
+        self.path = os.path.join(cache_dir(), 'sessions',
+            '%s.json' % digest(self.layers)[:16])
+
+    @contextmanager
+    def lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write(self, state):
+        atomic_write_json(self.path, state)
+
+    def __is_live(self, state):
+        backend = BACKENDS.get(state.get('backend', 'unionfs'))
+        return state.get('layers') == self.layers and backend is not None and \
+            backend().is_mounted(state['mountpoint'])
+
+    def __teardown(self, state):
+        reaper.spawn(state['mountpoint'], state['workspace'])
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def attach(self, backend=None):
+        # With a backend, a session mounted with any other one is left be.
+        state = self.__read()
+        if state is None:
+            return None
+        if self.__is_live(state):
+            if backend is not None and \
+                    state.get('backend', 'unionfs') != backend:
+                logger.debug("not attaching to %s: its backend isn't %s" %
+                    (self.path, backend))
+                return None
+            overlay = SessionOverlay(state)
+            with runner.span('overlay.refresh', backend=overlay.backend.name):
+                overlay.backend.refresh(self.layers, overlay.workspace,
+                    overlay.mountpoint)
+            return overlay
+
+        with self.lock():
+            state = self.__read()
+            if state is not None and not self.__is_live(state):
+                logger.debug('recovering stale session %s' % self.path)
+                self.__teardown(state)
+        return None
+
+    def status(self):
+        state = self.__read()
+        if state is None:
+            return None
+        return dict(state, live=self.__is_live(state))
+
+    def up(self, max_files=65536, backend='unionfs'):
+        with self.lock():
+            state = self.__read()
+            if state is not None:
+                if self.__is_live(state):
+                    return SessionOverlay(state)
+                logger.debug('recovering stale session %s' % self.path)
+                self.__teardown(state)
+
+            workspace = tempfile.mkdtemp(prefix='bandar-work-session-')
+            mountpoint = tempfile.mkdtemp(prefix='bandar-mnt-session-')
+            try:
+                with runner.span('overlay.mount', backend=backend):
+                    get_backend(backend).mount(self.layers, workspace,
+                        mountpoint, max_files)
+            except Exception:
+                shutil.rmtree(workspace, ignore_errors=True)
+                shutil.rmtree(mountpoint, ignore_errors=True)
+                raise
+
+            state = {
+                'layers': self.layers,
+                'backend': backend,
+                'workspace': workspace,
+                'mountpoint': mountpoint,
+                'created': time.time()
+            }
+            self.__write(state)
+            return SessionOverlay(state)
+
+    def down(self):
+        with self.lock():
+            state = self.__read()
+            if state is None:
+                return False
+            self.__teardown(state)
+            return True
@@ -0,0 +1,277 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Orders a set of ports by their dependencies on each other. A plan groups
+# the ports into waves, each of which only depends on earlier ones, and
+# ranks every port by the longest chain of work still waiting on it, using
+# how long the port took in earlier runs. A Schedule hands out the ports
+# in that order as they become ready and skips the dependents of failures.
+
+import heapq
+import json
+import os
+import os.path
+import threading
+
+from .cache import atomic_write_json, cache_dir
+
+VERSION = 1
+
+# Weight of the latest run in a port's smoothed duration
+SMOOTHING = 0.5
+# Duration assumed for a port with no history and nothing to compare to
+DEFAULT_DURATION = 60.0
+
+
+class DurationHistory:
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'durations.json')
+        self.__lock = threading.Lock()
+        self.__dirty = False
+        self.__entries = self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != VERSION:
+            return {}
+        return data.get('durations', {})
+
+    def get(self, kind, origin):
+        return self.__entries.get(kind, {}).get(origin)
+
+    def durations(self, kind):
+        return dict(self.__entries.get(kind, {}))
+
+    def record(self, kind, origin, seconds):
+        with self.__lock:
+            entries = self.__entries.setdefault(kind, {})
+            prev = entries.get(origin)
+            if prev is not None:
+                seconds = SMOOTHING * seconds + (1 - SMOOTHING) * prev
+            entries[origin] = seconds
+            self.__dirty = True
+
+    def save(self):
+        with self.__lock:
+            if not self.__dirty:
+                return
+            data = {'version': VERSION, 'durations': self.__entries}
+            self.__dirty = False
+
+        atomic_write_json(self.path, data)
+
+
+def nearest_targets(graph, targets, port):
+    # The targets `port` depends on, looking through any other ports in
+    # between but not past the first target on each path. A flavor of a
+    # target, like `devel/lib@py39`, counts as the target.
+    seen = {graph.index[port]}
+    order = list(seen)
+    out = []
+    for node in order:
+        for child in graph.edges[node]:
+            if child in seen:
+                continue
+            seen.add(child)
+            name = graph.names[child].split('@', 1)[0]
+            if name in targets:
+                if name != port and name not in out:
+                    out.append(name)
+            else:
+                order.append(child)
+    return out
+
+
+class BuildPlan:
+    def __init__(self, graph, ports, durations=None):
+        self.ports = list(dict.fromkeys(ports))
+        targets = set(self.ports)
+        self.deps = dict((p, nearest_targets(graph, targets, p))
+                         for p in self.ports)
+
+        durations = durations or {}
+        known = [durations[p] for p in self.ports if p in durations]
+        default = sum(known) / len(known) if known else DEFAULT_DURATION
+        self.durations = dict((p, durations.get(p, default))
+                              for p in self.ports)
+        self.estimated = set(p for p in self.ports if p not in durations)
+
+        self.broken = []
+        self.waves = self.__waves()
+        self.rdeps = dict((p, []) for p in self.ports)
+        for port, deps in self.deps.items():
+            for dep in deps:
+                self.rdeps[dep].append(port)
+
+        topo = [p for wave in self.waves for p in wave]
+        # rank: the longest chain of work from starting this port to the
+        # end of the plan; finish: the earliest this port could be done.
+        self.rank = {}
+        for port in reversed(topo):
+            self.rank[port] = self.durations[port] + max(
+                [self.rank[p] for p in self.rdeps[port]], default=0)
+        self.finish = {}
+        for port in topo:
+            self.finish[port] = self.durations[port] + max(
+                [self.finish[d] for d in self.deps[port]], default=0)
+        for wave in self.waves:
+            wave.sort(key=lambda p: (-self.rank[p], p))
+
+    def __waves(self):
+        # Kahn's algorithm, a level at a time. A cycle stalls it; one edge
+        # of a cycle is then dropped and recorded as broken.
+        waiting = dict((p, set(d)) for p, d in self.deps.items())
+        waves = []
+        while waiting:
+            wave = sorted(p for p, d in waiting.items() if len(d) == 0)
+            if len(wave) == 0:
+                self.__break_cycle(waiting)
+                continue
+            for port in wave:
+                del waiting[port]
+            for deps in waiting.values():
+                deps.difference_update(wave)
+            waves.append(wave)
+        return waves
+
+    def __break_cycle(self, waiting):
+        # Every waiting port has an unmet dependency, so following them
+        # must come back round; the cycle's port with the fewest unmet
+        # dependencies loses its edge within the cycle.
+        path = [min(waiting)]
+        seen = {path[0]: 0}
+        while True:
+            dep = min(waiting[path[-1]])
+            if dep in seen:
+                cycle = path[seen[dep]:]
+                break
+            seen[dep] = len(path)
+            path.append(dep)
+
+        i = min(range(len(cycle)), key=lambda i: (len(waiting[cycle[i]]),
+                                                  cycle[i]))
+        port, dep = cycle[i], cycle[(i + 1) % len(cycle)]
+        waiting[port].discard(dep)
+        self.deps[port].remove(dep)
+        self.broken.append((port, dep))
+
+    def order(self):
+        # Every port after its dependencies, longest chains first
+        pending = dict((p, len(d)) for p, d in self.deps.items())
+        ready = [(-self.rank[p], p) for p, n in pending.items() if n == 0]
+        heapq.heapify(ready)
+        out = []
+        while ready:
+            port = heapq.heappop(ready)[1]
+            out.append(port)
+            for parent in self.rdeps[port]:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    heapq.heappush(ready, (-self.rank[parent], parent))
+        return out
+
+    def critical_path(self):
+        if len(self.ports) == 0:
+            return []
+        port = max(self.ports, key=lambda p: (self.finish[p], p))
+        path = [port]
+        while len(self.deps[port]) > 0:
+            port = max(self.deps[port], key=lambda p: (self.finish[p], p))
+            path.append(port)
+        return list(reversed(path))
+
+    def to_dict(self):
+        path = self.critical_path()
+        return {
+            'waves': [[{'origin': p, 'seconds': self.durations[p],
+                        'estimated': p in self.estimated} for p in wave]
+                      for wave in self.waves],
+            'critical_path': path,
+            'critical_seconds': self.finish[path[-1]] if path else 0,
+            'total_seconds': sum(self.durations.values()),
+            'broken_edges': [list(e) for e in self.broken]
+        }
+
+
+class Schedule:
+    # Hands out a plan's ports to any number of threads, each only once
+    # all its dependencies have passed.
+    def __init__(self, plan):
+        self.plan = plan
+        self.__cond = threading.Condition()
+        self.__pending = dict((p, len(d)) for p, d in plan.deps.items())
+        self.__ready = [(-plan.rank[p], p) for p, n in self.__pending.items()
+                        if n == 0]
+        heapq.heapify(self.__ready)
+        self.__left = len(plan.ports)
+        self.__running = 0
+        self.__skipped = set()
+        self.__cancelled = False
+
+    def take(self):
+        # Blocks until a port is ready; None once there are none left.
+        with self.__cond:
+            while True:
+                if self.__cancelled or self.__left == 0:
+                    return None
+                if self.__ready:
+                    self.__running += 1
+                    return heapq.heappop(self.__ready)[1]
+                if self.__running == 0:
+                    return None
+                self.__cond.wait()
+
+    def done(self, port, passed):
+        # Returns the ports skipped because this one failed.
+        skipped = []
+        with self.__cond:
+            self.__running -= 1
+            self.__left -= 1
+            if passed:
+                for parent in self.plan.rdeps[port]:
+                    self.__pending[parent] -= 1
+                    if self.__pending[parent] == 0 and \
+                            parent not in self.__skipped:
+                        heapq.heappush(self.__ready,
+                                       (-self.plan.rank[parent], parent))
+            else:
+                order = [port]
+                for p in order:
+                    for parent in self.plan.rdeps[p]:
+                        if parent not in self.__skipped:
+                            self.__skipped.add(parent)
+                            skipped.append(parent)
+                            order.append(parent)
+                self.__left -= len(skipped)
+            self.__cond.notify_all()
+        return skipped
+
+    def cancel(self):
+        with self.__cond:
+            self.__cancelled = True
+            self.__cond.notify_all()
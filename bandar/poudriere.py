@@ -23,22 +23,99 @@
 # SUCH DAMAGE.
 
 import atexit
+import json
+import os
+import os.path
+import re
 import signal
 import subprocess
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
+import time
 import uuid
 
+from . import runner
+from .buildlog import BuildLogWatcher
+from .cache import atomic_write_json, cache_dir, digest
+from .overlay import OverlaySession
+from .reaper import pid_alive
+
+POUDRIERE_CONF = '/usr/local/etc/poudriere.conf'
+
+RE_CONF = re.compile(r'^\s*(\w+)=(.*)$')
+
+
+def conf_value(name, default=None, conf_path=POUDRIERE_CONF):
+    values = {'BASEFS': '/usr/local/poudriere'}
+    try:
+        with open(conf_path) as f:
+            for line in f:
+                m = RE_CONF.match(line.split('#', 1)[0])
+                if m is not None:
+                    values[m.group(1)] = m.group(2).strip().strip('"\'')
+    except OSError:
+        pass
+
+    value = values.get(name, default)
+    if value is None:
+        return None
+    for k, v in values.items():
+        value = value.replace('${%s}' % k, v).replace('$%s' % k, v)
+    return value
+
+
+def data_dir(conf_path=POUDRIERE_CONF):
+    return conf_value('POUDRIERE_DATA', '${BASEFS}/data', conf_path)
+
+
+def distfiles_dir(conf_path=POUDRIERE_CONF):
+    return conf_value('DISTFILES_CACHE', None, conf_path)
+
+
+def bulk_log_dir(jail_name, tree_name, build, conf_path=POUDRIERE_CONF):
+    return os.path.join(data_dir(conf_path), 'logs', 'bulk',
+        '%s-%s' % (jail_name, tree_name), build)
+
+
+def list_trees():
+    # Maps each poudriere ports tree to its path.
+    out = runner.check_output(['poudriere', 'ports', '-l', '-q'])
+    trees = {}
+    for line in out.decode().splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            trees[fields[0]] = fields[-1]
+    return trees
+
+
+def delete_tree(name):
+    runner.call(['poudriere', 'ports', '-d', '-k', '-p', name],
+        stdout=subprocess.DEVNULL)
+
+
+def temp_tree_pid(name):
+    # Temporary trees are named bandar-<pid>-<random>.
+    chunks = name.split('-')
+    if len(chunks) == 3 and chunks[0] == 'bandar' and chunks[1].isdigit():
+        return int(chunks[1])
+    return None
+
+
 class Poudriere:
-    def __init__(self, ports_path, name=None):
-        self.__cleaned = False
+    def __init__(self, ports_path, name=None, persistent=False):
+        self.__cleaned = persistent
 
-        self.name = name or uuid.uuid4().hex[:12]
+        self.name = name or 'bandar-%d-%s' % (os.getpid(), uuid.uuid4().hex[:8])
         self.ports_path = ports_path
+        self.persistent = persistent
+
+        if persistent and list_trees().get(self.name) == ports_path:
+            return
 
         cmd = ['poudriere', 'ports', '-c', '-F', '-f', 'none', '-M',
             self.ports_path, '-p', self.name]
-        subprocess.check_output(cmd)
-        atexit.register(self.__cleanup)
+        runner.check_output(cmd)
+        if not persistent:
+            atexit.register(self.__cleanup)
 
     def __del__(self):
         if not self.__cleaned:
@@ -46,11 +123,18 @@ class Poudriere:
 
     def __cleanup(self):
         atexit.unregister(self.__cleanup)
-        subprocess.call(['poudriere', 'ports', '-d', '-k', '-p', self.name])
+        delete_tree(self.name)
         self.__cleaned = True
 
-    def bulk(self, jail_name, *args):
+    def __bulk_cmd(self, jail_name, build, list_path):
+        return ['poudriere', 'bulk', '-C', '-j', jail_name, '-p', self.name,
+            '-B', build, '-f', list_path]
+
+    def bulk(self, jail_name, *args, watcher=None, interval=0.5):
+        # A BuildLogWatcher, if given, follows the build's logs as it runs.
         build = uuid.uuid4().hex
+        if watcher is not None:
+            watcher.attach(bulk_log_dir(jail_name, self.name, build))
 
         with NamedTemporaryFile('w', prefix='bandar-bulk-%s-' % build) as f:
             for arg in args:
@@ -58,10 +142,15 @@ class Poudriere:
             f.flush()
 
             try:
-                proc = subprocess.Popen(['poudriere', 'bulk', '-C', '-j', jail_name,
-                    '-p', self.name, '-B', build, '-f', f.name])
+                proc = runner.Popen(self.__bulk_cmd(jail_name, build, f.name))
                 signal.signal(signal.SIGINFO, lambda sig, _: proc.send_signal(sig))
                 signal.signal(signal.SIGINT, lambda sig, _: proc.send_signal(sig))
+                while watcher is not None:
+                    try:
+                        proc.wait(interval)
+                        break
+                    except subprocess.TimeoutExpired:
+                        watcher.poll()
                 proc.wait()
             except KeyboardInterrupt:
                 proc.terminate()
@@ -69,5 +158,221 @@ class Poudriere:
             finally:
                 signal.signal(signal.SIGINFO, signal.SIG_DFL)
                 signal.signal(signal.SIGINT, signal.SIG_DFL)
+                if watcher is not None:
+                    watcher.finish()
+
+        return build
+
+    async def bulk_async(self, engine, jail_name, *args, timeout=None):
+        build = uuid.uuid4().hex
+
+        with NamedTemporaryFile('w', prefix='bandar-bulk-%s-' % build) as f:
+            for arg in args:
+                f.write("%s\n" % arg)
+            f.flush()
+            await engine.run(self.__bulk_cmd(jail_name, build, f.name),
+                timeout=timeout, stdout=None)
 
         return build
+
+    def bulk_many(self, jail_names, ports, jobs=None, log_dir=None,
+                  on_update=None, watch=False, interval=0.5):
+        # Runs one bulk per jail against this ports tree, at most `jobs` at
+        # once. Each poudriere gets its own session and log, so one jail
+        # failing leaves the others running; SIGINFO is forwarded to every
+        # running build and SIGINT cancels them all.
+        jobs = max(1, jobs or len(jail_names))
+        log_dir = log_dir or mkdtemp(prefix='bandar-bulk-logs-')
+        os.makedirs(log_dir, exist_ok=True)
+        runs = [BulkRun(jail, log_dir) for jail in jail_names]
+        if watch:
+            for run in runs:
+                run.watcher = BuildLogWatcher(bulk_log_dir(run.jail,
+                    self.name, run.build))
+        pending = list(runs)
+        running = []
+        cancelled = []
+
+        def forward(sig, _):
+            for run in running:
+                run.proc.send_signal(sig)
+
+        with NamedTemporaryFile('w', prefix='bandar-bulk-') as f:
+            for port in ports:
+                f.write("%s\n" % port)
+            f.flush()
+
+            old_int = signal.signal(signal.SIGINT,
+                lambda sig, _: cancelled.append(sig))
+            old_info = signal.signal(signal.SIGINFO, forward)
+            try:
+                while len(pending) > 0 or len(running) > 0:
+                    if len(cancelled) > 0:
+                        for run in pending + running:
+                            run.cancel()
+                        pending = []
+
+                    for run in list(running):
+                        if run.poll():
+                            running.remove(run)
+                        if run.watcher is not None:
+                            run.watcher.poll()
+
+                    while len(pending) > 0 and len(running) < jobs:
+                        run = pending.pop(0)
+                        run.start(self.__bulk_cmd(run.jail, run.build, f.name))
+                        running.append(run)
+
+                    if on_update is not None:
+                        on_update(runs)
+                    if len(running) > 0:
+                        time.sleep(interval)
+            finally:
+                for run in running:
+                    run.cancel()
+                signal.signal(signal.SIGINT, old_int)
+                signal.signal(signal.SIGINFO, old_info)
+
+        for run in runs:
+            if run.watcher is not None:
+                run.watcher.finish()
+        if on_update is not None:
+            on_update(runs)
+        return runs
+
+
+class BulkRun:
+    def __init__(self, jail, log_dir):
+        self.jail = jail
+        self.build = uuid.uuid4().hex
+        self.log_path = os.path.join(log_dir, '%s.log' % jail)
+        self.state = 'queued'
+        self.proc = None
+        self.started = None
+        self.finished = None
+        self.watcher = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    def start(self, cmd):
+        with open(self.log_path, 'wb') as log:
+            self.proc = runner.Popen(cmd, stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.started = time.monotonic()
+        self.state = 'running'
+
+    def poll(self):
+        ret = self.proc.poll()
+        if ret is None:
+            return False
+        self.finished = time.monotonic()
+        if self.state == 'running':
+            self.state = 'done' if ret == 0 else 'failed'
+        return True
+
+    def cancel(self):
+        if self.proc is None:
+            self.state = 'cancelled'
+            return
+        if self.proc.poll() is None:
+            self.state = 'cancelled'
+            self.proc.terminate()
+            self.proc.wait()
+            self.poll()
+
+
+class PersistentTrees:
+    # Named ports trees that point at an overlay session's mountpoint and
+    # outlive the run that created them. Each is recorded with the layers
+    # and mountpoint it was made for, and recreated when either changes.
+    def __init__(self):
+        self.path = os.path.join(cache_dir(), 'poudriere')
+
+    def __record_path(self, name):
+        return os.path.join(self.path, '%s.json' % name)
+
+    def __read(self, name):
+        try:
+            with open(self.__record_path(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write(self, record):
+        atomic_write_json(self.__record_path(record['name']), record)
+
+    def __forget(self, name):
+        try:
+            os.unlink(self.__record_path(name))
+        except FileNotFoundError:
+            pass
+
+    def records(self):
+        out = []
+        if not os.path.isdir(self.path):
+            return out
+        for fn in sorted(os.listdir(self.path)):
+            if fn.endswith('.json') and not fn.startswith('.'):
+                record = self.__read(fn[:-5])
+                if record is not None:
+                    out.append(record)
+        return out
+
+    def default_name(self, layers):
+        return 'bandar-%s' % digest(layers)[:8]
+
+    def get(self, session, overlay, name=None):
+        name = name or self.default_name(session.layers)
+        with session.lock():
+            record = self.__read(name)
+            path = list_trees().get(name)
+            if path is not None and record is None:
+                raise ValueError("Ports tree '%s' already exists and isn't "
+                    "managed by bandar!" % name)
+            if record is not None and (record['layers'] != session.layers or
+                    path != overlay.mountpoint):
+                if path is not None:
+                    delete_tree(name)
+                self.__forget(name)
+
+            tree = Poudriere(overlay.mountpoint, name, persistent=True)
+            self.__write({
+                'name': name,
+                'layers': session.layers,
+                'mountpoint': overlay.mountpoint,
+                'created': (record or {}).get('created', time.time()),
+                'used': time.time()
+            })
+        return tree
+
+    def is_stale(self, record, trees):
+        if trees.get(record['name']) != record['mountpoint']:
+            return True
+        try:
+            state = OverlaySession(record['layers']).status()
+        except ValueError:
+            return True
+        return state is None or not state['live'] or \
+            state['mountpoint'] != record['mountpoint']
+
+    def prune(self):
+        trees = list_trees()
+        removed = []
+        for record in self.records():
+            if self.is_stale(record, trees):
+                if record['name'] in trees:
+                    delete_tree(record['name'])
+                self.__forget(record['name'])
+                removed.append(record['name'])
+
+        # Temporary trees left behind by runs that were killed
+        for name in sorted(trees):
+            pid = temp_tree_pid(name)
+            if pid is not None and not pid_alive(pid):
+                delete_tree(name)
+                removed.append(name)
+        return removed
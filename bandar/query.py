@@ -0,0 +1,183 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+from collections import namedtuple
+import logging
+import os
+import os.path
+import subprocess
+
+from . import runner
+from .engine import run_sync
+from .makefile import Unsupported
+
+logger = logging.getLogger('bandar.query')
+
+VARS = ['PKGNAME', 'FLAVORS', 'BUILD_DEPENDS', 'LIB_DEPENDS', 'RUN_DEPENDS',
+        'TEST_DEPENDS']
+
+PortInfo = namedtuple('PortInfo', ['origin', 'pkgname', 'flavors',
+    'build_depends', 'lib_depends', 'run_depends', 'test_depends'])
+
+END_MARKER = '--bandar-end--'
+
+# One shell per batch runs `make -V` in each port directory in turn and
+# terminates each port's block with a marker carrying its exit status.
+BATCH_SCRIPT = '''
+for o; do
+    case "$o" in
+        *@*) d="${o%%@*}"; f="${o#*@}" ;;
+        *) d="$o"; f="" ;;
+    esac
+    make -C "$d" ${f:+FLAVOR=$f} %s
+    echo "%s $?"
+done
+'''
+
+
+def split_flavor(origin):
+    if '@' in origin:
+        return tuple(origin.split('@', 1))
+    return origin, None
+
+
+def port_info_dict(info):
+    return dict(info._asdict())
+
+
+def port_info_from_dict(data):
+    return PortInfo(**data)
+
+
+class PortQuery:
+    def __init__(self, mountpoint, evaluator=None, verify=False):
+        self.mnt = mountpoint
+        self.evaluator = evaluator
+        self.verify = verify
+        self.mismatches = []
+        # Origins answered by the Makefile reader alone, without make
+        self.unverified = set()
+        self.mnt_len = len(self.mnt) + 1
+        self.env = dict(os.environ, PORTSDIR=self.mnt)
+        self.var_args = []
+        for var in VARS:
+            self.var_args += ['-V', var]
+
+    def strip_mount(self, path):
+        if path.startswith(self.mnt):
+            return path[self.mnt_len:]
+        return path
+
+    def parse_depends(self, value):
+        out = []
+        for dep in value.split():
+            chunks = dep.split(':')
+            if len(chunks) < 2:
+                continue
+            origin = self.strip_mount(chunks[1])
+            if origin not in out:
+                out.append(origin)
+        return out
+
+    def parse(self, origin, lines):
+        if len(lines) != len(VARS):
+            raise ValueError("Unexpected `make -V` output for '%s': %r" %
+                (origin, lines))
+        values = dict(zip(VARS, lines))
+        return PortInfo(
+            origin=origin,
+            pkgname=values['PKGNAME'],
+            flavors=values['FLAVORS'].split(),
+            build_depends=self.parse_depends(values['BUILD_DEPENDS']),
+            lib_depends=self.parse_depends(values['LIB_DEPENDS']),
+            run_depends=self.parse_depends(values['RUN_DEPENDS']),
+            test_depends=self.parse_depends(values['TEST_DEPENDS']))
+
+    def command(self, origin):
+        path, flavor = split_flavor(origin)
+        cmd = ['make'] + self.var_args
+        if flavor is not None:
+            cmd.append('FLAVOR=%s' % flavor)
+        return cmd, os.path.join(self.mnt, path)
+
+    def fast_query(self, origin):
+        if self.evaluator is None:
+            return None
+        try:
+            return self.parse(origin, self.evaluator.evaluate(origin))
+        except Unsupported:
+            return None
+
+    def compare(self, fast, info):
+        # With verify set, make stays authoritative and any disagreement
+        # with the Makefile reader is recorded.
+        if fast is None:
+            return info
+        same = fast.pkgname == info.pkgname and all(
+            set(getattr(fast, f)) == set(getattr(info, f))
+            for f in PortInfo._fields[2:])
+        if not same:
+            logger.warning("%s: Makefile reader disagrees with make: %r != %r"
+                % (info.origin, fast, info))
+            self.mismatches.append((fast, info))
+        return info
+
+    def query(self, origin):
+        return run_sync(self.query_async, origin)
+
+    async def query_async(self, engine, origin):
+        fast = self.fast_query(origin)
+        if fast is not None and not self.verify:
+            self.unverified.add(origin)
+            return fast
+
+        cmd, cwd = self.command(origin)
+        data = await engine.check_output(cmd, cwd=cwd, env=self.env)
+        return self.compare(fast,
+            self.parse(origin, data.decode().split('\n')[:len(VARS)]))
+
+    def query_many(self, origins):
+        if len(origins) == 1:
+            return [self.query(origins[0])]
+
+        script = BATCH_SCRIPT % (' '.join(self.var_args), END_MARKER)
+        cmd = ['sh', '-c', script, 'sh'] + list(origins)
+        data = runner.check_output(cmd, cwd=self.mnt, env=self.env)
+
+        out = []
+        lines = []
+        it = iter(origins)
+        for line in data.decode().split('\n'):
+            if not line.startswith(END_MARKER):
+                lines.append(line)
+                continue
+
+            origin = next(it)
+            ret = int(line[len(END_MARKER):])
+            if ret != 0:
+                raise subprocess.CalledProcessError(ret,
+                    ['make', '-C', origin] + self.var_args)
+            out.append(self.parse(origin, lines))
+            lines = []
+        return out
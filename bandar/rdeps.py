@@ -0,0 +1,227 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# A reverse-dependency index over the ports tree's INDEX-N file.
+#
+# The on-disk layout is a header followed by native-endian uint32 arrays:
+# the sorted origins as an offset table plus a byte blob, then for each
+# dependency kind a CSR adjacency (offsets, then the ids of the ports that
+# depend on each port). It is memory-mapped and never parsed on load.
+
+from array import array
+import glob
+import mmap
+import os
+import os.path
+import re
+import struct
+from tempfile import NamedTemporaryFile
+
+from . import runner
+from .cache import cache_dir, digest
+
+MAGIC = b'BRDX'
+VERSION = 2
+HEADER = struct.Struct('=4sIIIqq')
+
+KINDS = ['extract', 'patch', 'fetch', 'build', 'run']
+# Field numbers of each kind's dependency list in an INDEX line, which is
+# pkgname|path|prefix|comment|descr|maintainer|categories|build|run|www|
+# extract|patch|fetch
+KIND_FIELDS = [10, 11, 12, 7, 8]
+
+RE_INDEX = re.compile(r'INDEX-(\d+)$')
+
+
+def find_index(ports_dir):
+    found = []
+    for fn in glob.glob(os.path.join(ports_dir, 'INDEX-*')):
+        m = RE_INDEX.search(fn)
+        if m is not None:
+            found.append((int(m.group(1)), fn))
+    if len(found) == 0:
+        return None
+    return max(found)[1]
+
+
+def generate_index(ports_dir):
+    runner.check_call(['make', 'index'], cwd=ports_dir)
+    return find_index(ports_dir)
+
+
+def origin_of(path):
+    return "/".join(path.rstrip('/').split('/')[-2:])
+
+
+def parse_index(f):
+    # Streams the INDEX, yielding (pkgname, origin, [deps per kind]).
+    for line in f:
+        fields = line.rstrip('\n').split('|')
+        if len(fields) < 13:
+            continue
+        yield (fields[0], origin_of(fields[1]),
+               [fields[i].split() for i in KIND_FIELDS])
+
+
+def build_index(index_path, out_path):
+    st = os.stat(index_path)
+
+    pkgs = {}
+    entries = []
+    with open(index_path, encoding='utf-8', errors='replace') as f:
+        for pkgname, origin, deps in parse_index(f):
+            pkgs[pkgname] = origin
+            entries.append((origin, deps))
+
+    origins = sorted(set(origin for origin, _ in entries))
+    ids = dict((origin, i) for i, origin in enumerate(origins))
+    n = len(origins)
+
+    name_offsets = array('I', [0])
+    blob = bytearray()
+    for origin in origins:
+        blob += origin.encode()
+        name_offsets.append(len(blob))
+    blob += b'\x00' * (-len(blob) % 4)
+
+    # rdeps[k][i] holds every port that depends on port i by kind k
+    rdeps = [[set() for _ in range(n)] for _ in KINDS]
+    for origin, deps in entries:
+        src = ids[origin]
+        for k, names in enumerate(deps):
+            for name in names:
+                dep = pkgs.get(name)
+                if dep is not None:
+                    rdeps[k][ids[dep]].add(src)
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with NamedTemporaryFile('wb', dir=os.path.dirname(out_path),
+                            prefix='.rdeps-', delete=False) as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n, len(KINDS), st.st_mtime_ns,
+                            st.st_size))
+        name_offsets.tofile(f)
+        f.write(blob)
+        for per_port in rdeps:
+            offsets = array('I', [0])
+            targets = array('I')
+            for parents in per_port:
+                targets.extend(sorted(parents))
+                offsets.append(len(targets))
+            offsets.tofile(f)
+            targets.tofile(f)
+    os.replace(f.name, out_path)
+
+
+class ReverseIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.__mm)
+
+        magic, version, n, nkinds, self.src_mtime, self.src_size = \
+            HEADER.unpack_from(self.__mm)
+        if magic != MAGIC or version != VERSION or nkinds != len(KINDS):
+            raise ValueError("'%s' is not a bandar reverse-dependency index!" %
+                path)
+        self.count = n
+
+        pos = HEADER.size
+        self.__names = mv[pos:pos + 4 * (n + 1)].cast('I')
+        pos += 4 * (n + 1)
+        self.__blob = pos
+        pos += self.__names[n] + (-self.__names[n] % 4)
+
+        self.__kinds = []
+        for _ in KINDS:
+            offsets = mv[pos:pos + 4 * (n + 1)].cast('I')
+            pos += 4 * (n + 1)
+            targets = mv[pos:pos + 4 * offsets[n]].cast('I')
+            pos += 4 * offsets[n]
+            self.__kinds.append((offsets, targets))
+
+    @classmethod
+    def for_ports(cls, ports_dir, generate=False):
+        # Opens the cached index for a ports tree, rebuilding it whenever
+        # its INDEX file has changed.
+        index_path = find_index(ports_dir)
+        if index_path is None:
+            if not generate:
+                raise ValueError("No INDEX file found in '%s'; run "
+                    "`make fetchindex` or `make index` there first." % ports_dir)
+            index_path = generate_index(ports_dir)
+
+        out_path = os.path.join(cache_dir(),
+            'rdeps-%s.idx' % digest(os.path.abspath(index_path))[:16])
+        st = os.stat(index_path)
+        try:
+            index = cls(out_path)
+            if (index.src_mtime, index.src_size) == (st.st_mtime_ns, st.st_size):
+                return index
+        except (OSError, ValueError):
+            pass
+
+        build_index(index_path, out_path)
+        return cls(out_path)
+
+    def name(self, i):
+        start = self.__blob + self.__names[i]
+        end = self.__blob + self.__names[i + 1]
+        return self.__mm[start:end].decode()
+
+    def lookup(self, origin):
+        key = origin.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.__blob + self.__names[mid]
+            name = self.__mm[start:self.__blob + self.__names[mid + 1]]
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def rdeps(self, origin, kinds=None, transitive=True):
+        start = self.lookup(origin.split('@', 1)[0])
+        if start is None:
+            raise ValueError("'%s' is not in the ports INDEX!" % origin)
+
+        kinds = kinds or KINDS
+        csr = [self.__kinds[KINDS.index(kind)] for kind in kinds]
+
+        seen = {start}
+        order = [start]
+        for node in order:
+            for offsets, targets in csr:
+                for parent in targets[offsets[node]:offsets[node + 1]]:
+                    if parent not in seen:
+                        seen.add(parent)
+                        order.append(parent)
+            if not transitive and node == start:
+                break
+
+        return sorted(self.name(i) for i in order[1:])
@@ -0,0 +1,142 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Tears overlays down off the CLI's critical path. `spawn` hands a
+# mountpoint and its workspace to a detached `python -m bandar.reaper`,
+# which unmounts, deletes, and then sweeps up whatever crashed runs left
+# behind in the temporary directory.
+
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from . import runner
+
+FARM_MARKER = '.bandar-farm'
+
+RE_ORPHAN = re.compile(r'^bandar-(work|mnt)-(\d+)-')
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_mounted(path):
+    try:
+        os.stat(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # A FUSE mount whose daemon died fails to stat with ENOTCONN.
+        return True
+    return os.path.ismount(path)
+
+
+def unmount(mountpoint):
+    if is_mounted(mountpoint):
+        runner.call(['umount', '-f', mountpoint],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return not is_mounted(mountpoint)
+
+
+def remove_overlay(mountpoint, workspace=None):
+    # Leave everything in place if the overlay is still mounted; deleting
+    # the workspace underneath a live mount would only corrupt it.
+    if not unmount(mountpoint):
+        return False
+    if workspace is not None:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    # A symlink farm is a plain directory; rmtree never follows the links.
+    if os.path.isfile(os.path.join(mountpoint, FARM_MARKER)):
+        shutil.rmtree(mountpoint, ignore_errors=True)
+    else:
+        try:
+            os.rmdir(mountpoint)
+        except OSError:
+            pass
+    return True
+
+
+def find_orphans(tmpdir=None):
+    tmpdir = tmpdir or tempfile.gettempdir()
+    out = []
+    for name in sorted(os.listdir(tmpdir)):
+        m = RE_ORPHAN.match(name)
+        if m is None:
+            continue
+        pid = int(m.group(2))
+        if not pid_alive(pid):
+            out.append((m.group(1), pid, os.path.join(tmpdir, name)))
+    return out
+
+
+def sweep(tmpdir=None):
+    orphans = find_orphans(tmpdir)
+    removed = []
+
+    # Unmount every dead run's mountpoint before touching any workspace,
+    # and keep the workspaces of any run whose overlay won't come down.
+    busy = set()
+    for kind, pid, path in orphans:
+        if kind == 'mnt':
+            if not remove_overlay(path):
+                busy.add(pid)
+            elif not os.path.exists(path):
+                removed.append(path)
+
+    for kind, pid, path in orphans:
+        if kind == 'work' and pid not in busy:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
+
+
+def spawn(mountpoint, workspace=None):
+    cmd = [sys.executable, '-m', 'bandar.reaper', mountpoint]
+    if workspace is not None:
+        cmd.append(workspace)
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    args = sys.argv[1:]
+    if len(args) > 0:
+        remove_overlay(*args[:2])
+    sweep()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Every external command bandar runs goes through here. When profiling is
+# on, each one is recorded with its argv, cwd, wall and CPU time, exit
+# code and output size, alongside spans for in-process work such as
+# mounting overlays, and the lot can be written out as a Chrome trace.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import os.path
+import subprocess
+import threading
+import time
+
+PROFILER = None
+
+
+class Profiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def now(self):
+        return int((time.perf_counter() - self.start) * 1e6)
+
+    def add(self, name, cat, ts, args):
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': ts,
+            'dur': self.now() - ts,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args
+        }
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    def write_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        # (name, count, wall, cpu, output bytes, failures), slowest first
+        rows = OrderedDict()
+        with self.lock:
+            events = list(self.events)
+        for e in events:
+            row = rows.setdefault(e['name'], [0, 0, 0, 0, 0])
+            row[0] += 1
+            row[1] += e['dur'] / 1e6
+            row[2] += e['args'].get('cpu_user', 0) + \
+                e['args'].get('cpu_sys', 0)
+            row[3] += e['args'].get('output_bytes') or 0
+            row[4] += e['args'].get('exit_code') not in (None, 0)
+        return sorted(((k,) + tuple(v) for k, v in rows.items()),
+                      key=lambda x: -x[2])
+
+
+def enable_profiling():
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+@contextmanager
+def span(name, **args):
+    if PROFILER is None:
+        yield
+        return
+    ts = PROFILER.now()
+    try:
+        yield
+    finally:
+        PROFILER.add(name, 'bandar', ts, args)
+
+
+class CountingReader:
+    def __init__(self, f, counter):
+        self.__f = f
+        self.__counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.__f, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.__f.readline()
+        if not line:
+            raise StopIteration
+        self.__counter['output_bytes'] += len(line)
+        return line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.__f.close()
+
+    def read(self, *args):
+        data = self.__f.read(*args)
+        self.__counter['output_bytes'] += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.__f.readline(*args)
+        self.__counter['output_bytes'] += len(line)
+        return line
+
+
+def file_size(f):
+    try:
+        fd = f if isinstance(f, int) else f.fileno()
+        return os.fstat(fd).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class Popen(subprocess.Popen):
+    def __init__(self, args, *posargs, **kwargs):
+        self.rusage = None
+        self._trace_event = None
+        self._trace_stats = None
+        if PROFILER is None:
+            super().__init__(args, *posargs, **kwargs)
+            return
+
+        self._trace_ts = PROFILER.now()
+        self._trace_stats = {
+            'argv': [str(a) for a in args] if isinstance(args, (list, tuple))
+                    else [str(args)],
+            'cwd': os.path.abspath(kwargs.get('cwd') or os.getcwd()),
+            'output_bytes': 0
+        }
+        stdout = kwargs.get('stdout')
+        self._trace_out = None
+        if stdout not in (None, subprocess.PIPE, subprocess.DEVNULL):
+            self._trace_out = (stdout, file_size(stdout))
+
+        super().__init__(args, *posargs, **kwargs)
+        if self.stdout is not None:
+            self.stdout = CountingReader(self.stdout, self._trace_stats)
+
+    def _trace_reap(self, timeout=None):
+        # Reaps the child with os.wait4 before subprocess does, so that its
+        # CPU time is known; only done when profiling.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        while self.returncode is None:
+            flags = 0 if deadline is None else os.WNOHANG
+            try:
+                pid, sts, rusage = os.wait4(self.pid, flags)
+            except ChildProcessError:
+                return
+            if pid == self.pid:
+                self.rusage = rusage
+                self.returncode = os.waitstatus_to_exitcode(sts)
+                return
+            if deadline is None or time.monotonic() >= deadline:
+                return
+            delay = min(delay * 2, 0.05, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+    def _trace_record(self):
+        if self._trace_stats is None or self._trace_event is not None or \
+                self.returncode is None:
+            return
+        stats = self._trace_stats
+        stats['exit_code'] = self.returncode
+        if self.rusage is not None:
+            stats['cpu_user'] = self.rusage.ru_utime
+            stats['cpu_sys'] = self.rusage.ru_stime
+        if self._trace_out is not None and self._trace_out[1] is not None:
+            size = file_size(self._trace_out[0])
+            if size is not None:
+                stats['output_bytes'] = size - self._trace_out[1]
+        name = os.path.basename(stats['argv'][0])
+        self._trace_event = PROFILER.add(name, 'subprocess', self._trace_ts, stats)
+
+    def wait(self, timeout=None):
+        if self._trace_stats is not None:
+            self._trace_reap(timeout)
+        ret = super().wait(0 if timeout is not None and
+                           self.returncode is None else timeout)
+        self._trace_record()
+        return ret
+
+    def poll(self):
+        if self._trace_stats is not None:
+            self._trace_reap(0)
+        ret = super().poll()
+        self._trace_record()
+        return ret
+
+    def set_output_bytes(self, n):
+        if self._trace_stats is not None:
+            self._trace_stats['output_bytes'] = n
+
+
+def call(*popenargs, timeout=None, **kwargs):
+    with Popen(*popenargs, **kwargs) as p:
+        try:
+            return p.wait(timeout)
+        except BaseException:
+            p.kill()
+            raise
+
+
+def check_call(*popenargs, **kwargs):
+    ret = call(*popenargs, **kwargs)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, kwargs.get('args',
+            popenargs[0] if popenargs else None))
+    return 0
+
+
+def check_output(*popenargs, timeout=None, **kwargs):
+    with Popen(*popenargs, stdout=subprocess.PIPE, **kwargs) as p:
+        try:
+            out, err = p.communicate(timeout=timeout)
+        except BaseException:
+            p.kill()
+            raise
+        p.set_output_bytes(len(out))
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args,
+                output=out, stderr=err)
+    return out
@@ -0,0 +1,321 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Watches a development tree and reports which ports changed. kqueue is
+# used on the BSDs, inotify (through libc) on Linux, and polling stat()
+# wherever neither is available. Each watcher's read() returns the
+# changed paths, relative to the tree.
+
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import time
+
+from .cache import stat_key
+
+SKIP_DIRS = {'.git', '.hg', '.svn', 'work'}
+
+
+def ignored(name):
+    # Editor swap and backup files
+    return name.startswith('.') or name.endswith('~') or \
+        name.endswith('.swp') or name.endswith('.swx')
+
+
+def walk_tree(root):
+    # Yields (relative dir, [files]) for every watched directory.
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if d not in SKIP_DIRS and not ignored(d))
+        yield (os.path.relpath(dirpath, root),
+               [f for f in filenames if not ignored(f)])
+
+
+def norm(path):
+    path = os.path.normpath(path)
+    return '' if path == '.' else path
+
+
+class PollWatcher:
+    name = 'poll'
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.root = None
+        self.keys = {}
+
+    def available(self):
+        return True
+
+    def scan(self):
+        out = {}
+        for rel, files in walk_tree(self.root):
+            out[rel] = stat_key(os.path.join(self.root, rel))
+            for fn in files:
+                path = os.path.join(rel, fn)
+                out[path] = stat_key(os.path.join(self.root, path))
+        return out
+
+    def start(self, root):
+        self.root = root
+        self.keys = self.scan()
+
+    def read(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            keys = self.scan()
+            changed = [norm(p) for p in set(keys) | set(self.keys)
+                       if keys.get(p) != self.keys.get(p)]
+            self.keys = keys
+            if len(changed) > 0:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class KqueueWatcher:
+    # One vnode filter per directory and file; a directory's NOTE_WRITE
+    # means an entry was added, removed or renamed, so it is listed again.
+    name = 'kqueue'
+
+    def __init__(self):
+        self.root = None
+        self.kq = None
+        self.fds = {}
+        self.paths = {}
+
+    def available(self):
+        return hasattr(select, 'kqueue')
+
+    def __add(self, rel):
+        if rel in self.fds:
+            return
+        try:
+            fd = os.open(os.path.join(self.root, rel), os.O_RDONLY)
+        except OSError:
+            return
+        self.fds[rel] = fd
+        self.paths[fd] = rel
+        flags = select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | \
+            select.KQ_NOTE_ATTRIB | select.KQ_NOTE_DELETE | \
+            select.KQ_NOTE_RENAME
+        self.kq.control([select.kevent(fd, filter=select.KQ_FILTER_VNODE,
+            flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR, fflags=flags)], 0)
+
+    def __remove(self, rel):
+        fd = self.fds.pop(rel, None)
+        if fd is not None:
+            del self.paths[fd]
+            os.close(fd)
+
+    def __add_tree(self, rel):
+        for sub, files in walk_tree(os.path.join(self.root, rel)):
+            sub = norm(os.path.join(rel, sub))
+            self.__add(sub)
+            for fn in files:
+                self.__add(os.path.join(sub, fn))
+
+    def start(self, root):
+        self.root = root
+        self.kq = select.kqueue()
+        self.__add_tree('')
+
+    def read(self, timeout=None):
+        events = self.kq.control(None, 256, timeout)
+        changed = set()
+        for ev in events:
+            rel = self.paths.get(ev.ident)
+            if rel is None:
+                continue
+            changed.add(rel)
+            if ev.fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME):
+                self.__remove(rel)
+            if os.path.isdir(os.path.join(self.root, rel)):
+                for name in os.listdir(os.path.join(self.root, rel)):
+                    path = norm(os.path.join(rel, name))
+                    if path in self.fds or ignored(name) or \
+                            name in SKIP_DIRS:
+                        continue
+                    changed.add(path)
+                    if os.path.isdir(os.path.join(self.root, path)):
+                        self.__add_tree(path)
+                    else:
+                        self.__add(path)
+        return list(changed)
+
+    def close(self):
+        for rel in list(self.fds):
+            self.__remove(rel)
+        if self.kq is not None:
+            self.kq.close()
+
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    name = 'inotify'
+
+    def __init__(self):
+        self.root = None
+        self.fd = None
+        self.dirs = {}
+        self.libc = None
+
+    def available(self):
+        if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+            return False
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True)
+            return hasattr(self.libc, 'inotify_init1')
+        except OSError:
+            return False
+
+    def __add_tree(self, rel):
+        for sub, files in walk_tree(os.path.join(self.root, rel)):
+            sub = norm(os.path.join(rel, sub))
+            wd = self.libc.inotify_add_watch(self.fd,
+                os.path.join(self.root, sub).encode(), IN_MASK)
+            if wd >= 0:
+                self.dirs[wd] = sub
+
+    def start(self, root):
+        if self.libc is None:
+            self.available()
+        self.root = root
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.__add_tree('')
+
+    def read(self, timeout=None):
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if len(r) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        changed = set()
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length]
+            pos += EVENT.size + length
+            name = name.rstrip(b'\x00').decode(errors='replace')
+
+            rel = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            if rel is None or (name and (ignored(name) or name in SKIP_DIRS)):
+                continue
+            path = norm(os.path.join(rel, name))
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.__add_tree(path)
+        return list(changed)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+WATCHERS = {
+    'kqueue': KqueueWatcher,
+    'inotify': InotifyWatcher,
+    'poll': PollWatcher
+}
+
+PREFERRED = ['kqueue', 'inotify', 'poll']
+
+
+def get_watcher(name=None):
+    if name is None:
+        for name in PREFERRED:
+            watcher = WATCHERS[name]()
+            if watcher.available():
+                return watcher
+    if name not in WATCHERS:
+        raise ValueError("Unknown watcher '%s'!" % name)
+    watcher = WATCHERS[name]()
+    if not watcher.available():
+        raise ValueError("The watcher '%s' is not available here!" % name)
+    return watcher
+
+
+def changes(watcher, delay=0.1):
+    # Yields the set of paths changed by each burst of writes, once the
+    # tree has been quiet for `delay` seconds.
+    while True:
+        changed = set(watcher.read())
+        while True:
+            more = watcher.read(delay)
+            if len(more) == 0:
+                break
+            changed.update(more)
+        yield changed
+
+
+def changed_ports(paths, root, ports=None):
+    # Maps changed paths to the origins of the ports containing them.
+    # With `ports`, only those are reported; otherwise any directory two
+    # levels down holding a Makefile is a port.
+    out = set()
+    for path in paths:
+        chunks = path.split('/')
+        if len(chunks) < 2:
+            continue
+        origin = '/'.join(chunks[:2])
+        if ports is not None:
+            if origin in ports:
+                out.add(origin)
+        elif os.path.isfile(os.path.join(root, origin, 'Makefile')):
+            out.add(origin)
+    return sorted(out)
@@ -0,0 +1,93 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Compares the overlay backends on the same commands:
+#
+#   python benchmarks/overlay_backends.py -d ~/ports-dev -p /usr/ports \
+#       -t www/foo -l www/foo -l www/bar
+
+import argparse
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bandar import Bandar, TreeGenerator
+from bandar.overlay import BACKENDS
+
+
+def timed(fn, *args, **kwargs):
+    start = time.monotonic()
+    fn(*args, **kwargs)
+    return time.monotonic() - start
+
+
+def stat_walk(root, ports):
+    for port in ports:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, port)):
+            for fn in filenames:
+                os.stat(os.path.join(dirpath, fn))
+
+
+def bench(backend, args):
+    row = {}
+    start = time.monotonic()
+    bandar = Bandar(args.dev_path, args.ports_path, use_session=False,
+        backend=backend)
+    row['mount'] = time.monotonic() - start
+
+    row['stat'] = timed(stat_walk, bandar.overlay.mountpoint,
+        args.lint_ports + args.tree_ports)
+    row['tree'] = timed(lambda: [TreeGenerator(bandar, jobs=args.jobs).run(p)
+                                 for p in args.tree_ports])
+    row['lint'] = timed(lambda: list(bandar.lint_ports(args.lint_ports, '-gAC',
+                                                       jobs=args.jobs)))
+    row['umount'] = timed(bandar.overlay.close)
+    return row
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('-d', dest='dev_path', default=os.getcwd())
+    p.add_argument('-p', dest='ports_path', default='/usr/ports')
+    p.add_argument('-b', dest='backends', action='append',
+        help='Backend to include (default: every available backend)')
+    p.add_argument('-t', dest='tree_ports', action='append', default=[])
+    p.add_argument('-l', dest='lint_ports', action='append', default=[])
+    p.add_argument('-j', dest='jobs', type=int, default=1)
+    args = p.parse_args()
+
+    backends = args.backends or [name for name, cls in sorted(BACKENDS.items())
+                                 if cls().available()]
+    cols = ['mount', 'stat', 'tree', 'lint', 'umount']
+
+    print('%-10s' % 'backend' + ''.join('%10s' % c for c in cols))
+    for backend in backends:
+        row = bench(backend, args)
+        print('%-10s' % backend + ''.join('%9.3fs' % row[c] for c in cols))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Times bandar commands on synthetic ports trees of growing size, using
+# the stub toolchain from synthetic.py, so it runs on any host:
+#
+#   python benchmarks/suite.py -s chain -n 100 -n 1000 -L make=0.005
+#
+# Each result is appended to a JSON lines file and compared with the last
+# result recorded for the same command, shape, size, latencies and jobs.
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bandar.cache import cache_dir
+
+COMMANDS = {
+    'tree': lambda b: ['tree', '-j', str(b.jobs), '--no-cache', b.dev_ports[0]],
+    'tree-fast': lambda b: ['tree', '-j', str(b.jobs), '--no-cache', '--fast',
+                            b.dev_ports[0]],
+    'lint': lambda b: ['lint', '-j', str(b.jobs), '--no-cache', 'all'],
+    'test': lambda b: ['test', '-j', str(b.jobs), 'all'],
+    'archive': lambda b: ['archive', '-j', str(b.jobs), '--force', '-o',
+                          os.path.join(b.root, 'archives'), 'all'],
+}
+
+
+class Bench:
+    def __init__(self, shape, size, jobs, latencies, dev_ports=None):
+        self.shape = shape
+        self.size = size
+        self.jobs = jobs
+        self.root = tempfile.mkdtemp(prefix='bandar-bench-')
+        try:
+            self.dev_dir, self.ports_dir, self.dev_ports = \
+                synthetic.generate(self.root, shape, size, dev_ports)
+        except Exception:
+            self.close()
+            raise
+
+        bin_dir = synthetic.install_stubs(os.path.join(self.root, 'bin'))
+        self.env = dict(os.environ,
+            PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            PYTHONPATH=ROOT, XDG_CACHE_HOME=os.path.join(self.root, 'cache'))
+        for name, secs in latencies.items():
+            self.env['BENCH_%s_LATENCY' % name.upper()] = str(secs)
+
+    def run(self, command):
+        cmd = [sys.executable, '-m', 'bandar', '-d', self.dev_dir, '-p',
+               self.ports_dir] + COMMANDS[command](self)
+        start = time.monotonic()
+        proc = subprocess.run(cmd, env=self.env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        elapsed = time.monotonic() - start
+        if proc.returncode != 0:
+            raise RuntimeError("%s failed:\n%s" % (" ".join(cmd),
+                proc.stderr.decode(errors='replace')))
+        return elapsed
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(r):
+    return (r['command'], r['shape'], r['size'], r['jobs'],
+            tuple(sorted(r['latencies'].items())))
+
+
+def load_results(path):
+    out = []
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    out.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return out
+
+
+def parse_latency(value):
+    name, _, secs = value.partition('=')
+    if name not in synthetic.STUBS:
+        raise argparse.ArgumentTypeError("no stub called '%s'" % name)
+    return name, float(secs)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('-s', dest='shapes', action='append',
+        choices=synthetic.SHAPES, help='Dependency shape (default: chain)')
+    p.add_argument('-n', dest='sizes', action='append', type=int,
+        help='Number of ports in the tree (default: 100 and 1000)')
+    p.add_argument('-c', dest='commands', action='append',
+        choices=sorted(COMMANDS), help='Command to time (default: all)')
+    p.add_argument('-j', dest='jobs', type=int, default=4)
+    p.add_argument('-d', dest='dev_ports', type=int,
+        help='Number of development ports (default: a tenth of the tree)')
+    p.add_argument('-L', dest='latencies', action='append', default=[],
+        type=parse_latency, help='Stub latency as name=seconds')
+    p.add_argument('-r', dest='repeat', type=int, default=3,
+        help='Runs of each command; the fastest is kept (default: 3)')
+    p.add_argument('-o', dest='results_path',
+        default=os.path.join(cache_dir(), 'benchmarks.jsonl'),
+        help='JSON lines file of past results (default: benchmarks.jsonl '
+             "in bandar's cache directory)")
+    p.add_argument('-t', dest='threshold', type=float, default=0.25,
+        help='Slowdown over the last result that counts as a regression '
+             '(default: 0.25)')
+    args = p.parse_args()
+
+    latencies = dict(args.latencies)
+    previous = {}
+    for r in load_results(args.results_path):
+        previous[result_key(r)] = r
+
+    revision = git_revision()
+    regressions = 0
+    print('%-8s %-8s %6s %10s %12s %8s' % ('command', 'shape', 'ports',
+        'seconds', 'ms/port', 'change'))
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_path)),
+                exist_ok=True)
+    with open(args.results_path, 'a') as out:
+        for shape in args.shapes or ['chain']:
+            for size in args.sizes or [100, 1000]:
+                bench = Bench(shape, size, args.jobs, latencies,
+                    args.dev_ports)
+                try:
+                    for command in args.commands or sorted(COMMANDS):
+                        elapsed = min(bench.run(command)
+                                      for _ in range(max(1, args.repeat)))
+                        r = {
+                            'time': time.time(),
+                            'revision': revision,
+                            'command': command,
+                            'shape': shape,
+                            'size': size,
+                            'dev_ports': len(bench.dev_ports),
+                            'jobs': args.jobs,
+                            'latencies': latencies,
+                            'seconds': round(elapsed, 4)
+                        }
+
+                        change = ''
+                        last = previous.get(result_key(r))
+                        if last is not None and last['seconds'] > 0:
+                            ratio = elapsed / last['seconds']
+                            change = '%+.0f%%' % ((ratio - 1) * 100)
+                            if ratio > 1 + args.threshold:
+                                change += ' !'
+                                regressions += 1
+
+                        print('%-8s %-8s %6d %9.3fs %12.3f %8s' % (command,
+                            shape, size, elapsed, elapsed * 1000 / size,
+                            change))
+                        out.write(json.dumps(r, sort_keys=True) + '\n')
+                        out.flush()
+                finally:
+                    bench.close()
+
+    if regressions > 0:
+        print('%d regression(s) over %.0f%%' % (regressions,
+            args.threshold * 100))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
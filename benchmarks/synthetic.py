@@ -0,0 +1,248 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Synthetic ports trees and a stub FreeBSD toolchain, so that bandar can
+# be benchmarked on any host. Every stub sleeps for BENCH_<NAME>_LATENCY
+# seconds (if set) before doing the least work bandar needs from it.
+
+import os
+import os.path
+import random
+import stat
+import subprocess
+
+SHAPES = ['chain', 'fan', 'diamond', 'random']
+
+STUB_MAKE = r'''#!/bin/sh
+[ -n "$BENCH_MAKE_LATENCY" ] && sleep "$BENCH_MAKE_LATENCY"
+vars=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -C) cd "$2" || exit 1; shift 2 ;;
+        -V) vars="$vars $2"; shift 2 ;;
+        *) shift ;;
+    esac
+done
+exec awk -v vars="$vars" -v portsdir="$PORTSDIR" '
+    { i = index($0, "="); if (i) val[substr($0, 1, i - 1)] = substr($0, i + 1) }
+    END {
+        n = split(vars, v, " ")
+        for (k = 1; k <= n; k++) {
+            s = val[v[k]]
+            gsub(/\$\{PORTSDIR\}/, portsdir, s)
+            print s
+        }
+    }' Makefile
+'''
+
+STUB_PORTLINT = r'''#!/bin/sh
+if [ "$1" = "-v" ]; then
+    echo "portlint version 2.19.0"
+    exit 0
+fi
+[ -n "$BENCH_PORTLINT_LATENCY" ] && sleep "$BENCH_PORTLINT_LATENCY"
+echo "WARN: Makefile: [1]: synthetic warning."
+echo "0 fatal errors and 1 warning found."
+'''
+
+STUB_PORT = r'''#!/bin/sh
+[ -n "$BENCH_PORT_LATENCY" ] && sleep "$BENCH_PORT_LATENCY"
+echo "===> Testing for $(basename "$PWD")"
+'''
+
+STUB_SHAR = r'''#!/bin/sh
+[ -n "$BENCH_SHAR_LATENCY" ] && sleep "$BENCH_SHAR_LATENCY"
+for f; do
+    echo "# $f"
+    [ -f "$f" ] && cat "$f"
+done
+'''
+
+# Merges the read-only layers into the mountpoint with symlinks, one level
+# below each category, and marks it the way the reaper recognises a
+# symlink farm so that it is removed once the run is over.
+STUB_UNIONFS = r'''#!/usr/bin/env python3
+import os, sys, time
+time.sleep(float(os.environ.get('BENCH_UNIONFS_LATENCY') or 0))
+args = [a for a in sys.argv[1:] if not a.startswith('-') and 'max_files' not in a]
+branches, mnt = args[-2], args[-1]
+for branch in branches.split(':'):
+    layer, mode = branch.rsplit('=', 1)
+    if mode != 'RO':
+        continue
+    for name in os.listdir(layer):
+        src, dst = os.path.join(layer, name), os.path.join(mnt, name)
+        if name.startswith('.'):
+            continue
+        if os.path.isdir(src) and name != 'Mk':
+            os.makedirs(dst, exist_ok=True)
+            for port in os.listdir(src):
+                if not os.path.lexists(os.path.join(dst, port)):
+                    os.symlink(os.path.join(src, port), os.path.join(dst, port))
+        elif not os.path.lexists(dst):
+            os.symlink(src, dst)
+open(os.path.join(mnt, '.bandar-farm'), 'w').close()
+'''
+
+STUB_UMOUNT = r'''#!/bin/sh
+exit 0
+'''
+
+STUB_POUDRIERE = r'''#!/usr/bin/env python3
+import json, os, sys, time
+state = os.path.join(os.environ.get('XDG_CACHE_HOME', '/tmp'), 'poudriere.json')
+trees = json.load(open(state)) if os.path.exists(state) else {}
+latency = float(os.environ.get('BENCH_POUDRIERE_LATENCY') or 0)
+args = sys.argv[1:]
+if args[0] == 'ports':
+    if '-l' in args:
+        for name, path in sorted(trees.items()):
+            print(name, 'null', '1970-01-01 00:00:00', path)
+    elif '-c' in args:
+        trees[args[args.index('-p') + 1]] = args[args.index('-M') + 1]
+    elif '-d' in args:
+        trees.pop(args[args.index('-p') + 1], None)
+    json.dump(trees, open(state, 'w'))
+elif args[0] == 'bulk':
+    with open(args[args.index('-f') + 1]) as f:
+        time.sleep(latency * len(f.read().split()))
+'''
+
+STUBS = {
+    'make': STUB_MAKE,
+    'portlint': STUB_PORTLINT,
+    'port': STUB_PORT,
+    'shar': STUB_SHAR,
+    'unionfs': STUB_UNIONFS,
+    'umount': STUB_UMOUNT,
+    'poudriere': STUB_POUDRIERE,
+}
+
+
+def install_stubs(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, script in STUBS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+            stat.S_IXOTH)
+    return bin_dir
+
+
+def origin(i):
+    return 'cat%02d/port%05d' % (i // 100, i)
+
+
+def edges(shape, size, rng):
+    # Dependencies of each port i, always on ports numbered above i so the
+    # graph stays acyclic; port 0 reaches every other port.
+    deps = [[] for _ in range(size)]
+    if shape == 'chain':
+        for i in range(size - 1):
+            deps[i].append(i + 1)
+    elif shape == 'fan':
+        deps[0] = list(range(1, size))
+    elif shape == 'diamond':
+        # Levels of four ports, each depending on every port of the next.
+        width = 4
+        for i in range(size):
+            level = (i + width - 1) // width
+            first = level * width + 1
+            if i == 0:
+                deps[i] = list(range(1, min(size, width + 1)))
+            else:
+                deps[i] = list(range(first, min(size, first + width)))
+    elif shape == 'random':
+        for i in range(1, size):
+            parent = rng.randrange(0, i)
+            if i not in deps[parent]:
+                deps[parent].append(i)
+            for _ in range(2):
+                j = rng.randrange(0, size)
+                if j > i and j not in deps[i]:
+                    deps[i].append(j)
+    else:
+        raise ValueError("Unknown shape '%s'" % shape)
+    return deps
+
+
+def write_port(root, i, deps):
+    path = os.path.join(root, origin(i))
+    os.makedirs(os.path.join(path, 'files'), exist_ok=True)
+
+    # Alternate between library and run dependencies, which bandar's tree
+    # follows by default.
+    lib = ' '.join('lib%05d.so:${PORTSDIR}/%s' % (d, origin(d))
+                   for d in deps[0::2])
+    run = ' '.join('port%05d>0:${PORTSDIR}/%s' % (d, origin(d))
+                   for d in deps[1::2])
+    with open(os.path.join(path, 'Makefile'), 'w') as f:
+        f.write('PORTNAME=port%05d\n' % i)
+        f.write('PKGNAME=port%05d-1.0\n' % i)
+        f.write('FLAVORS=\n')
+        f.write('BUILD_DEPENDS=\n')
+        f.write('LIB_DEPENDS=%s\n' % lib)
+        f.write('RUN_DEPENDS=%s\n' % run)
+        f.write('TEST_DEPENDS=\n')
+    with open(os.path.join(path, 'pkg-descr'), 'w') as f:
+        f.write('Synthetic port %d\n' % i)
+    with open(os.path.join(path, 'files', 'patch-Makefile'), 'w') as f:
+        f.write('--- Makefile.orig\n+++ Makefile\n')
+
+
+def write_index(ports_dir, deps):
+    with open(os.path.join(ports_dir, 'INDEX-14'), 'w') as f:
+        for i, d in enumerate(deps):
+            names = ' '.join('port%05d-1.0' % x for x in d)
+            # build and run dependencies, then www, extract, patch and fetch
+            f.write('port%05d-1.0|/usr/ports/%s|/usr/local|synthetic|'
+                    '/usr/ports/%s/pkg-descr|ports@FreeBSD.org|%s|%s|%s||||\n' %
+                    (i, origin(i), origin(i), origin(i).split('/')[0], names,
+                     names))
+
+
+def generate(root, shape='chain', size=100, dev_ports=None, seed=0):
+    # Returns (dev tree, upstream tree, dev port origins). Ports 0 to
+    # dev_ports - 1 are the ones under development; the rest are upstream.
+    rng = random.Random(seed)
+    deps = edges(shape, size, rng)
+    dev_ports = max(1, min(size, dev_ports or size // 10))
+
+    ports_dir = os.path.join(root, 'ports')
+    dev_dir = os.path.join(root, 'dev')
+    os.makedirs(os.path.join(ports_dir, 'Mk'), exist_ok=True)
+    with open(os.path.join(ports_dir, 'Mk', 'bsd.port.mk'), 'w') as f:
+        f.write('# synthetic\n')
+    for i in range(size):
+        write_port(dev_dir if i < dev_ports else ports_dir, i, deps[i])
+    write_index(ports_dir, deps)
+
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@')
+    for cmd in (['git', 'init', '-q'], ['git', 'add', '-A'],
+                ['git', 'commit', '-q', '-m', 'synthetic']):
+        subprocess.check_call(cmd, cwd=dev_dir, env=env)
+
+    return dev_dir, ports_dir, [origin(i) for i in range(dev_ports)]
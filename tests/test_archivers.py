@@ -0,0 +1,65 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Archives written from index entries, without git.
+
+import io
+import tarfile
+
+import pytest
+
+from bandar.archivers import generate_archive, write_shar, write_tar
+
+BLOBS = {'a1': b'PORTNAME=foo\n', 'b2': b'pkg-descr\n'}
+ENTRIES = [
+    ('100644', 'a1', 'devel/foo/Makefile'),
+    ('100644', 'b2', 'devel/foo/pkg-descr'),
+    ('160000', 'c3', 'devel/foo/vendor'),
+]
+
+
+def test_shar_skips_submodules():
+    f = io.BytesIO()
+    write_shar(f, ENTRIES, BLOBS.__getitem__)
+    data = f.getvalue()
+    assert b"'devel/foo/Makefile'" in data
+    assert b'XPORTNAME=foo\n' in data
+    assert b'vendor' not in data
+
+
+def test_tar_skips_submodules():
+    f = io.BytesIO()
+    write_tar(f, ENTRIES, BLOBS.__getitem__)
+    f.seek(0)
+    with tarfile.open(fileobj=f) as tar:
+        assert tar.getnames() == ['devel', 'devel/foo', 'devel/foo/Makefile',
+                                  'devel/foo/pkg-descr']
+
+
+def test_archive_error_is_not_hidden(tmp_path):
+    out = str(tmp_path / 'missing' / 'foo.shar')
+    with pytest.raises(FileNotFoundError) as e:
+        generate_archive(str(tmp_path), 'devel/foo', out, entries=ENTRIES,
+            reader=object())
+    assert e.value.filename == out + '.tmp'
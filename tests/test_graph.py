@@ -0,0 +1,64 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Dependency graphs and the reverse walks over them.
+
+from bandar.graph import DependencyGraph, dependents
+
+DEPS = {
+    'www/app': ['devel/lib@py39', 'devel/tool'],
+    'devel/lib@py39': ['devel/base'],
+    'devel/tool': [],
+    'devel/base': [],
+    'x11/viewer': ['www/app'],
+    'misc/other': ['devel/tool'],
+}
+
+
+def test_dependents_direct_and_transitive():
+    assert dependents(DEPS, ['devel/tool']) == {'www/app', 'x11/viewer',
+                                                'misc/other'}
+
+
+def test_dependents_through_flavored_dependency():
+    assert dependents(DEPS, ['devel/lib']) == {'www/app', 'x11/viewer'}
+
+
+def test_dependents_of_flavored_port_parent():
+    assert dependents(DEPS, ['devel/base']) == {'devel/lib', 'www/app',
+                                                'x11/viewer'}
+
+
+def test_dependents_excludes_given_ports():
+    assert dependents(DEPS, ['devel/tool', 'www/app']) == {'x11/viewer',
+                                                           'misc/other'}
+
+
+def test_graph_shares_nodes():
+    graph = DependencyGraph()
+    graph.add('a', ['b', 'c'])
+    graph.add('b', ['c'])
+    assert len(graph) == 3
+    assert graph.children('a') == ['b', 'c']
+    assert graph.find_cycles() == []
@@ -0,0 +1,188 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Known Makefiles and the values `make -V` gives for them, for the
+# pure-Python reader in bandar.makefile.
+
+import pytest
+
+from bandar.makefile import (MakefileEvaluator, Unsupported, assign,
+    check_safe, expand, package_name, parse_makefile, port_version)
+
+SIMPLE = '''\
+# Created by: someone
+PORTNAME=	foo
+DISTVERSION=	1.2.0-rc3
+PORTREVISION=	2
+CATEGORIES=	www python
+PKGNAMEPREFIX=	py-
+
+MAINTAINER=	ports@FreeBSD.org
+COMMENT=	Example port
+
+LIB_DEPENDS=	libbar.so:${PORTSDIR}/devel/bar
+RUN_DEPENDS=	baz>0:devel/baz \\
+		qux>=1:${PORTSDIR}/www/qux
+RUN_DEPENDS+=	${LOCALBASE}/bin/x:x11/x
+USES=		gmake
+
+do-install:
+	${INSTALL_PROGRAM} ${WRKSRC}/foo ${STAGEDIR}${PREFIX}/bin
+
+.include <bsd.port.mk>
+'''
+
+
+class FakeUses:
+    def __init__(self, uses=None, base=None):
+        self.uses = uses or {}
+        self.base = base or {}
+
+    def get(self, uses):
+        return self.uses[uses]
+
+    def baseline(self):
+        return dict((kind, self.base.get(kind, '')) for kind in
+                    ['BUILD_DEPENDS', 'LIB_DEPENDS', 'RUN_DEPENDS',
+                     'TEST_DEPENDS'])
+
+
+def values_of(text):
+    return assign(parse_makefile(text))
+
+
+def test_assignments():
+    values = values_of(SIMPLE)
+    assert values['PORTNAME'] == 'foo'
+    assert values['RUN_DEPENDS'].split() == ['baz>0:devel/baz',
+        'qux>=1:${PORTSDIR}/www/qux', '${LOCALBASE}/bin/x:x11/x']
+    assert 'INSTALL_PROGRAM' not in values
+
+
+def test_assignment_operators():
+    values = values_of('A=1\nA?=2\nB?=3\nC=x\nC+=y\nD:=4\n')
+    assert values == {'A': '1', 'B': '3', 'C': 'x y', 'D': '4'}
+
+
+@pytest.mark.parametrize('text', [
+    '.if defined(X)\nA=1\n.endif\n',
+    '.include "${.CURDIR}/../../devel/foo/Makefile"\n',
+    '.include <bsd.port.options.mk>\n',
+    'A!=\techo 1\n',
+    '${A}_DEPENDS=\tx:y/z\n',
+])
+def test_unsupported_syntax(text):
+    with pytest.raises(Unsupported):
+        parse_makefile(text)
+
+
+@pytest.mark.parametrize('text', [
+    'OPTIONS_DEFINE=\tDOCS\n',
+    'FLAVORS=\tpy38 py39\n',
+    'MASTERDIR=\t${.CURDIR}/../foo\n',
+    'USE_GNOME=\tgtk30\n',
+    'DOCS_RUN_DEPENDS=\tx:y/z\n',
+    'BUILD_DEPENDS_amd64=\tx:y/z\n',
+])
+def test_unsafe_variables(text):
+    with pytest.raises(Unsupported):
+        check_safe(values_of(text))
+
+
+def test_safe_variables():
+    check_safe(values_of('USE_GITHUB=\tyes\nUSE_LDCONFIG=\tyes\nFLAVORS=\n'))
+
+
+def test_expand():
+    builtins = {'PORTSDIR': '/mnt', 'LOCALBASE': '/usr/local',
+                'FILESDIR': '${.CURDIR}/files', '.CURDIR': '/mnt/www/foo'}
+    values = {'A': '${B}/a', 'B': 'b'}
+    assert expand('${A} $(B) ${PORTSDIR}/x $$', values, builtins) == \
+        'b/a b /mnt/x $'
+    assert expand('${FILESDIR}/x', values, builtins) == '/mnt/www/foo/files/x'
+    for bad in ['${A:S/a/b/}', '${UNKNOWN}', '${C}']:
+        with pytest.raises(Unsupported):
+            expand(bad, {'C': '${C}'}, builtins)
+
+
+# PORTVERSION as bsd.port.mk derives it from DISTVERSION
+@pytest.mark.parametrize('distversion, portversion', [
+    ('1.2.3', '1.2.3'),
+    ('1.2.0-rc3', '1.2.0.r3'),
+    ('2.0.0-beta1', '2.0.0.b1'),
+    ('1.0a', '1.0.a'),
+    ('v1_2', 'v1.2'),
+    ('2021-03-04', '2021.03.04'),
+    ('1.0+git', '1.0+g'),
+])
+def test_port_version(distversion, portversion):
+    assert port_version(distversion) == portversion
+
+
+def test_package_name():
+    values = values_of(SIMPLE)
+    get = lambda name: expand(values.get(name, ''), values, {})
+    assert package_name(values, get) == 'py-foo-1.2.0.r3_2'
+
+    values = values_of('PORTNAME=\tbar\nPORTVERSION=\t3.1\nPORTEPOCH=\t1\n'
+                       'PKGNAMESUFFIX=\t-nox11\n')
+    get = lambda name: expand(values.get(name, ''), values, {})
+    assert package_name(values, get) == 'bar-nox11-3.1,1'
+
+    values = values_of('PORTNAME=\tbar\nPORTVERSION=\t3\nPKGNAME=\tbaz-1\n')
+    assert package_name(values, get) == 'baz-1'
+
+
+def test_evaluator(tmp_path):
+    port = tmp_path / 'www' / 'foo'
+    port.mkdir(parents=True)
+    (port / 'Makefile').write_text(SIMPLE)
+    mnt = str(tmp_path)
+    uses = FakeUses(
+        uses={'gmake': {'flavors': '', 'BUILD_DEPENDS':
+                        ['gmake>=4:${PORTSDIR}/devel/gmake'],
+                        'LIB_DEPENDS': [], 'RUN_DEPENDS': [],
+                        'TEST_DEPENDS': []}},
+        base={'BUILD_DEPENDS': 'ccache:${PORTSDIR}/devel/ccache'})
+
+    lines = MakefileEvaluator(mnt, uses).evaluate('www/foo')
+    assert lines == [
+        'py-foo-1.2.0.r3_2',
+        '',
+        'gmake>=4:%s/devel/gmake ccache:%s/devel/ccache' % (mnt, mnt),
+        'libbar.so:%s/devel/bar' % mnt,
+        'baz>0:devel/baz qux>=1:%s/www/qux /usr/local/bin/x:x11/x' % mnt,
+        '',
+    ]
+
+
+def test_evaluator_falls_back(tmp_path):
+    port = tmp_path / 'www' / 'foo'
+    port.mkdir(parents=True)
+    (port / 'Makefile').write_text('PORTNAME=\tfoo\nOPTIONS_DEFINE=\tX\n')
+    ev = MakefileEvaluator(str(tmp_path), FakeUses())
+    for origin in ['www/foo', 'www/foo@py39', 'www/missing']:
+        with pytest.raises(Unsupported):
+            ev.evaluate(origin)
+    assert (ev.hits, ev.misses) == (0, 3)
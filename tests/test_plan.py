@@ -0,0 +1,68 @@
+# Copyright (c) 2015  Brendan Molloy <brendan+freebsd@bbqsrc.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Build plans over small dependency graphs.
+
+from bandar.graph import DependencyGraph
+from bandar.plan import BuildPlan, Schedule
+
+
+def make_graph(deps):
+    graph = DependencyGraph()
+    for port, children in deps.items():
+        graph.add(port, children)
+    return graph
+
+
+def test_plan_through_flavored_dependency():
+    graph = make_graph({
+        'www/app': ['devel/lib@py39'],
+        'devel/lib@py39': ['devel/base'],
+        'devel/lib': ['devel/base'],
+    })
+    plan = BuildPlan(graph, ['www/app', 'devel/lib'])
+    assert plan.deps == {'www/app': ['devel/lib'], 'devel/lib': []}
+    assert plan.waves == [['devel/lib'], ['www/app']]
+
+
+def test_plan_looks_through_other_ports():
+    graph = make_graph({
+        'www/app': ['devel/mid'],
+        'devel/mid': ['devel/lib'],
+        'devel/lib': [],
+    })
+    plan = BuildPlan(graph, ['www/app', 'devel/lib'])
+    assert plan.deps['www/app'] == ['devel/lib']
+
+
+def test_schedule_skips_dependents_of_failures():
+    graph = make_graph({
+        'www/app': ['devel/lib@py39'],
+        'devel/lib@py39': [],
+        'devel/lib': [],
+    })
+    schedule = Schedule(BuildPlan(graph, ['www/app', 'devel/lib']))
+    assert schedule.take() == 'devel/lib'
+    assert list(schedule.done('devel/lib', False)) == ['www/app']
+    assert schedule.take() is None